@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+"""
+Measures the main entry points of notifications against synthetic data.
+
+    python benchmarks/run.py --scales 1000,10000,100000 --transport smtp --output results.json
+    python benchmarks/run.py --compare results.json
+
+For every scenario and scale it reports the throughput, the p50/p99 latency of
+a call, the database queries made and the peak memory allocated by Python, and
+can save them as JSON to compare runs with ``--compare``.
+"""
+from __future__ import print_function, division
+
+import os
+import sys
+import gc
+import json
+import time
+import argparse
+import platform
+import subprocess
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import django
+
+
+SCENARIOS = ["send_now", "send_now_fanout", "queue", "send_all", "send_subscriptions"]
+
+# the history each user's digest is made of
+DIGEST_HISTORY = 5
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(fraction * (len(samples) - 1))))]
+
+
+class QueryCounter(object):
+    """
+    Counts the queries run on a connection without keeping them, as
+    ``CaptureQueriesContext`` would.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.count = 0
+
+    def __enter__(self):
+        from django.db.backends.utils import CursorWrapper
+
+        counter = self
+
+        class CountingCursorWrapper(CursorWrapper):
+            def execute(self, sql, params=None):
+                counter.count += 1
+                return super(CountingCursorWrapper, self).execute(sql, params)
+
+            def executemany(self, sql, param_list):
+                counter.count += 1
+                return super(CountingCursorWrapper, self).executemany(sql, param_list)
+
+        self.force_debug_cursor = self.connection.force_debug_cursor
+        self.connection.force_debug_cursor = True
+        self.connection.make_debug_cursor = lambda cursor: CountingCursorWrapper(cursor, self.connection)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.connection.force_debug_cursor = self.force_debug_cursor
+        del self.connection.make_debug_cursor
+
+
+def reset_database():
+    from django.core.management import call_command
+    from notifications.models import NoticeType
+
+    call_command("flush", interactive=False, verbosity=0)
+    NoticeType.objects.clear_cache()
+
+
+def create_users(count):
+    from django.contrib.auth import get_user_model
+    from django.contrib.auth.hashers import make_password
+
+    usermodel = get_user_model()
+    password = make_password("benchmark")
+    usermodel.objects.bulk_create(
+        [usermodel(username="user{0}".format(i), email="user{0}@example.com".format(i), password=password)
+         for i in range(count)],
+        batch_size=500
+    )
+    return usermodel.objects.order_by("pk")
+
+
+def create_data(scale):
+    """
+    Creates ``scale`` users, a notice type, and an opt-out setting for one user
+    in ten.
+    """
+    from notifications.models import NoticeType, NoticeSetting
+
+    reset_database()
+    users = create_users(scale)
+    NoticeType.create("benchmark", "Benchmark", "a notice sent by the benchmarks")
+    notice_type = NoticeType.objects.get(label="benchmark")
+    NoticeSetting.objects.bulk_create(
+        [NoticeSetting(user_id=pk, notice_type=notice_type, medium="0", send=False)
+         for pk in users.values_list("pk", flat=True)[::10]],
+        batch_size=500
+    )
+    return users
+
+
+def setup_send_now(scale):
+    users = list(create_data(scale)[:min(scale, 500)])
+
+    def run():
+        from notifications.models import send_now
+
+        samples = []
+        for user in users:
+            start = time.time()
+            send_now([user], "benchmark", {"value": user.pk})
+            samples.append(time.time() - start)
+        return len(users), samples
+    return run
+
+
+def setup_send_now_fanout(scale):
+    users = create_data(scale)
+
+    def run():
+        from notifications.models import send_now
+
+        start = time.time()
+        send_now(users, "benchmark", {"value": 1})
+        return scale, [time.time() - start]
+    return run
+
+
+def setup_queue(scale):
+    users = create_data(scale)
+
+    def run():
+        from notifications.models import queue
+
+        start = time.time()
+        queue(users, "benchmark", {"value": 1})
+        return scale, [time.time() - start]
+    return run
+
+
+def setup_send_all(scale):
+    from notifications.models import queue
+
+    queue(create_data(scale), "benchmark", {"value": 1})
+
+    def run():
+        from notifications.engine import send_all
+
+        start = time.time()
+        send_all()
+        return scale, [time.time() - start]
+    return run
+
+
+def setup_send_subscriptions(scale):
+    from django.utils import timezone
+    from notifications.models import NoticeType, NoticeHistory, NoticeThrough, DigestSubscription
+
+    user_ids = list(create_data(scale).values_list("pk", flat=True))
+    notice_type = NoticeType.objects.get(label="benchmark")
+    now = timezone.now()
+    for i in range(DIGEST_HISTORY):
+        history = NoticeHistory.objects.create(notice_type=notice_type, sender="benchmarks@example.com",
+                                               sent_at=now - timedelta(minutes=i + 1))
+        NoticeThrough.objects.bulk_create(
+            [NoticeThrough(user_id=user_id, history=history) for user_id in user_ids], batch_size=500
+        )
+    DigestSubscription.objects.bulk_create(
+        [DigestSubscription(user_id=user_id, notice_type="benchmark", emit_at=now, frequency=60)
+         for user_id in user_ids],
+        batch_size=500
+    )
+
+    def run():
+        from notifications.engine import send_subscriptions
+
+        start = time.time()
+        send_subscriptions()
+        return scale, [time.time() - start]
+    return run
+
+
+def measure(scenario, scale, memory):
+    from django.core import mail
+    from django.db import connection
+
+    setup = globals()["setup_{0}".format(scenario)]
+    run = setup(scale)
+    mail.outbox = []
+    gc.collect()
+    with QueryCounter(connection) as counter:
+        start = time.time()
+        items, samples = run()
+        elapsed = time.time() - start
+    result = {
+        "scenario": scenario,
+        "scale": scale,
+        "items": items,
+        "seconds": elapsed,
+        "throughput": items / elapsed if elapsed else None,
+        "p50": percentile(samples, 0.5),
+        "p99": percentile(samples, 0.99),
+        "queries": counter.count,
+        "peak_memory": None,
+    }
+
+    if memory and tracemalloc is not None:
+        # measured in a second run, as tracing allocations slows everything down
+        run = setup(scale)
+        mail.outbox = []
+        gc.collect()
+        tracemalloc.start()
+        try:
+            run()
+            result["peak_memory"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    mail.outbox = []
+    return result
+
+
+def environment(transport):
+    try:
+        revision = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "database": "sqlite3",
+        "transport": transport,
+        "revision": revision,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def format_row(result, previous=None):
+    def fmt(value, spec):
+        return "-" if value is None else format(value, spec)
+
+    row = "{0:<20} {1:>8} {2:>12} {3:>10} {4:>10} {5:>9} {6:>10}".format(
+        result["scenario"], result["scale"],
+        fmt(result["throughput"], ".1f"),
+        fmt(result["p50"] * 1000, ".2f"),
+        fmt(result["p99"] * 1000, ".2f"),
+        result["queries"],
+        fmt(result["peak_memory"] and result["peak_memory"] / 1024 / 1024, ".1f"),
+    )
+    if previous is not None and previous.get("throughput") and result["throughput"]:
+        row += " {0:+.1%}".format(result["throughput"] / previous["throughput"] - 1)
+    return row
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the notifications entry points.")
+    parser.add_argument("--scales", default="1000",
+                        help="comma separated numbers of users, e.g. 1000,10000,100000")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help="comma separated scenarios among {0}".format(", ".join(SCENARIOS)))
+    parser.add_argument("--transport", choices=["locmem", "smtp"], default="locmem",
+                        help="send email to the locmem outbox or to an in-process SMTP server")
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+                        help="skip the second run measuring peak memory")
+    parser.add_argument("--output", help="save the results as JSON to this file")
+    parser.add_argument("--compare", help="show the throughput change against results saved before")
+    args = parser.parse_args(argv)
+
+    scales = [int(scale) for scale in args.scales.split(",")]
+    scenarios = args.scenarios.split(",")
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            parser.error("unknown scenario {0}".format(scenario))
+
+    os.environ["DJANGO_SETTINGS_MODULE"] = "benchmarks.settings"
+    from django.conf import settings
+
+    sink = None
+    if args.transport == "smtp":
+        from benchmarks.smtp_sink import SMTPSink
+
+        sink = SMTPSink()
+        sink.start()
+        settings.EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
+        settings.EMAIL_HOST = "127.0.0.1"
+        settings.EMAIL_PORT = sink.port
+    django.setup()
+
+    from django.db import connection
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as fp:
+            for result in json.load(fp)["results"]:
+                previous[(result["scenario"], result["scale"])] = result
+
+    connection.creation.create_test_db(verbosity=0)
+    results = []
+    print("{0:<20} {1:>8} {2:>12} {3:>10} {4:>10} {5:>9} {6:>10}".format(
+        "scenario", "scale", "items/s", "p50 ms", "p99 ms", "queries", "peak MiB"
+    ))
+    try:
+        for scale in scales:
+            for scenario in scenarios:
+                result = measure(scenario, scale, args.memory)
+                results.append(result)
+                print(format_row(result, previous.get((scenario, scale))))
+                sys.stdout.flush()
+    finally:
+        if sink is not None:
+            sink.stop()
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump({"environment": environment(args.transport), "results": results}, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
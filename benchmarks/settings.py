@@ -0,0 +1,25 @@
+SECRET_KEY = "benchmarks"
+
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": "benchmarks",
+    }
+}
+
+EMAIL_BACKEND = "django.core.mail.backends.locmem.EmailBackend"
+
+INSTALLED_APPS = [
+    "django.contrib.auth",
+    "django.contrib.contenttypes",
+    "django.contrib.sites",
+    "djcelery",
+    "notifications",
+]
+
+MIDDLEWARE_CLASSES = ()
+
+SITE_ID = 1
+
+# the user passwords don't matter, so hash them as cheaply as possible
+PASSWORD_HASHERS = ["django.contrib.auth.hashers.MD5PasswordHasher"]
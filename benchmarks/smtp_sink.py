@@ -0,0 +1,57 @@
+"""
+A minimal SMTP server that accepts and counts every message, so the email
+backend can be measured over a real socket without a mail server.
+"""
+import threading
+
+from six.moves import socketserver
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        self.reply("220 localhost sink")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command == b"EHLO":
+                self.reply("250-localhost")
+                self.reply("250 8BITMIME")
+            elif command == b"DATA":
+                self.reply("354 go ahead")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                self.server.received += 1
+                self.reply("250 ok")
+            elif command == b"QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                # HELO, MAIL, RCPT, RSET and NOOP
+                self.reply("250 ok")
+
+
+class SMTPSink(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0):
+        socketserver.TCPServer.__init__(self, (host, port), SMTPHandler)
+        self.received = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -1,6 +1,11 @@
+import sys
+
 from notifications.models import send, queue, send_now
 from notifications.engine import send_digest, send_all, send_subscriptions
 
+if sys.version_info >= (3, 5):
+    from notifications.aio import asend_now, aqueue
+
 __version__ = "1.0.0"
 
 default_app_config = "notifications.apps.AppConfig"
@@ -9,6 +9,17 @@ class NoticeHistoryAdmin(admin.ModelAdmin):
     readonly_fields = ["notice_type", "recipient", "sender", "extra_context", "attachments", "sent_at"]
 
 
+class NoticeQueueBatchAdmin(admin.ModelAdmin):
+    list_display = ["id", "priority", "send_at", "claimed_by", "position", "attempts", "failed_at"]
+    list_filter = ["priority", "failed_at"]
+    readonly_fields = ["claimed_by", "lease_until", "position", "attempts", "last_error", "failed_at"]
+    actions = ["requeue"]
+
+    def requeue(self, request, queryset):
+        queryset.requeue()
+    requeue.short_description = "Retry the selected batches"
+
+
 class NoticeTypeAdmin(admin.ModelAdmin):
     list_display = ["label", "display", "description", "default"]
 
@@ -47,7 +58,7 @@ class DigestSubscriptionAdmin(admin.ModelAdmin):
 
 
 admin.site.register(DigestSubscription, DigestSubscriptionAdmin)
-admin.site.register(NoticeQueueBatch)
+admin.site.register(NoticeQueueBatch, NoticeQueueBatchAdmin)
 admin.site.register(NoticeType, NoticeTypeAdmin)
 admin.site.register(NoticeSetting, NoticeSettingAdmin)
 admin.site.register(NoticeHistory, NoticeHistoryAdmin)
@@ -0,0 +1,153 @@
+"""
+asyncio entry points, for Python 3.5 and later.
+
+The database work of a notice runs on a small pool of NOTIFICATIONS_ASYNC_WORKERS
+threads, since the ORM is synchronous, while the messages it renders are sent
+through the backends' ``asend_messages`` on the event loop.
+"""
+import time
+import asyncio
+import threading
+import weakref
+from collections import OrderedDict
+from functools import partial
+
+from django.db import close_old_connections
+
+from notifications.backends import get_backend_label
+from notifications.conf import settings
+from notifications.metrics import record_delivery
+from notifications.ratelimit import batch_size, reserve
+from notifications.models import deliver_notice, queue
+
+
+_executor = None
+_semaphores = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    from concurrent.futures import ThreadPoolExecutor
+
+    workers = settings.NOTIFICATIONS_ASYNC_WORKERS
+    with _lock:
+        if _executor is None or _executor[0] != workers:
+            if _executor is not None:
+                _executor[1].shutdown(wait=False)
+            _executor = (workers, ThreadPoolExecutor(workers))
+        return _executor[1]
+
+
+def run_sync(func, loop=None):
+    """
+    Runs ``func`` on the database threads and returns a future of its result.
+    """
+    def run():
+        close_old_connections()
+        try:
+            return func()
+        finally:
+            close_old_connections()
+
+    loop = loop or asyncio.get_event_loop()
+    return loop.run_in_executor(get_executor(), run)
+
+
+def get_semaphore(loop, backend):
+    """
+    Returns the semaphore limiting the sends of the backend running on the loop
+    at once, following NOTIFICATIONS_DELIVERY_LIMITS, or None.
+    """
+    limit = settings.NOTIFICATIONS_DELIVERY_LIMITS.get(get_backend_label(backend))
+    if not limit:
+        return None
+    semaphores = _semaphores.setdefault(loop, {})
+    key = (id(backend), limit)
+    if key not in semaphores:
+        semaphores[key] = asyncio.Semaphore(limit)
+    return semaphores[key]
+
+
+async def asend_messages(backend, messages):
+    if getattr(backend, "records_metrics", False):
+        return await backend.asend_messages(messages)
+    start = time.time()
+    try:
+        sent = await backend.asend_messages(messages)
+    except Exception:
+        record_delivery(backend, failed=len(messages), seconds=time.time() - start)
+        raise
+    record_delivery(backend, delivered=len(messages), seconds=time.time() - start)
+    return sent
+
+
+class AsyncDispatcher(object):
+    """
+    A dispatcher for ``deliver_notice`` that sends the messages on the event
+    loop in chunks of NOTIFICATIONS_DELIVERY_CHUNK_SIZE per backend. It is used
+    from a database thread, and ``wait`` blocks that thread, not the loop.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.chunk_size = settings.NOTIFICATIONS_DELIVERY_CHUNK_SIZE
+        self.pending = OrderedDict()
+        self.futures = []
+
+    def add(self, backend, recipient, message):
+        chunk = self.pending.setdefault(backend, [])
+        chunk.append((recipient, message))
+        if len(chunk) >= batch_size(backend, self.chunk_size):
+            self.submit(backend)
+
+    def submit(self, backend):
+        chunk = self.pending.pop(backend, None)
+        if not chunk:
+            return
+        future = asyncio.run_coroutine_threadsafe(
+            self.send(backend, [message for _, message in chunk]), self.loop
+        )
+        self.futures.append((future, [recipient for recipient, _ in chunk]))
+
+    async def send(self, backend, messages):
+        if not getattr(backend, "throttles", False):
+            delay = reserve(backend, len(messages))
+            if delay:
+                await asyncio.sleep(delay)
+        semaphore = get_semaphore(self.loop, backend)
+        if semaphore is None:
+            return await asend_messages(backend, messages)
+        async with semaphore:
+            return await asend_messages(backend, messages)
+
+    def wait(self):
+        for backend in list(self.pending):
+            self.submit(backend)
+        sent, errors = set(), []
+        for future, recipients in self.futures:
+            error = future.exception()
+            if error is None:
+                sent.update(recipients)
+            else:
+                errors.append(error)
+        self.futures = []
+        return sent, errors
+
+
+async def asend_now(users, label, extra_context=None, sender=None, scoping=None, attachments=None, **kwargs):
+    """
+    The asyncio version of ``send_now``.
+    """
+    loop = asyncio.get_event_loop()
+    sent_users = await run_sync(partial(
+        deliver_notice, users, label, extra_context, sender, scoping, attachments,
+        dispatcher=AsyncDispatcher(loop)
+    ), loop)
+    return bool(sent_users)
+
+
+async def aqueue(users, label, extra_context=None, sender=None, send_at=None, attachments=None, priority=0):
+    """
+    The asyncio version of ``queue``.
+    """
+    return await run_sync(partial(queue, users, label, extra_context, sender, send_at, attachments, priority))
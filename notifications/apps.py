@@ -1,5 +1,5 @@
 from django.apps import AppConfig as BaseAppConfig
-from django.db.models.signals import post_migrate
+from django.db.models.signals import post_migrate, post_save, post_delete
 
 from djcelery.models import PeriodicTask, CrontabSchedule
 
@@ -15,4 +15,15 @@ class AppConfig(BaseAppConfig):
     verbose_name = "Notifications"
 
     def ready(self):
+        from django.contrib.sites.models import Site
+        from notifications.backends.base import clear_default_context_cache
+        from notifications.models import NoticeType, NoticeSetting, clear_notice_type_cache
+        from notifications.utils import clear_notice_setting_cache
+
         post_migrate.connect(create_periodic_task, sender=self)
+        post_save.connect(clear_default_context_cache, sender=Site)
+        post_delete.connect(clear_default_context_cache, sender=Site)
+        post_save.connect(clear_notice_type_cache, sender=NoticeType)
+        post_delete.connect(clear_notice_type_cache, sender=NoticeType)
+        post_save.connect(clear_notice_setting_cache, sender=NoticeSetting)
+        post_delete.connect(clear_notice_setting_cache, sender=NoticeSetting)
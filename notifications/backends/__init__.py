@@ -0,0 +1,63 @@
+from contextlib import contextmanager
+
+from notifications.conf import settings
+
+
+def get_backend_label(backend):
+    """
+    Returns the label the backend is configured with in NOTIFICATIONS_BACKENDS,
+    or "default" for NOTIFICATIONS_DEFAULT_BACKEND.
+    """
+    for (medium_id, label), instance in settings.NOTIFICATIONS_BACKENDS.items():
+        if instance is backend:
+            return label
+    return "default"
+
+
+def get_backends():
+    """
+    Returns every configured backend instance, including the default backend
+    used for plain email addresses.
+    """
+    backends = list(settings.NOTIFICATIONS_BACKENDS.values())
+    if settings.NOTIFICATIONS_DEFAULT_BACKEND not in backends:
+        backends.append(settings.NOTIFICATIONS_DEFAULT_BACKEND)
+    return backends
+
+
+class BackendRun(list):
+    """
+    The backends opened by ``open_backends``. Once the outermost run is over,
+    ``delivered`` maps the label of each backend that counts what it sends to
+    the number of messages it sent during the run.
+    """
+    def __init__(self, backends):
+        super(BackendRun, self).__init__(backends)
+        self.delivered = {}
+
+
+@contextmanager
+def open_backends():
+    """
+    Opens every backend for the duration of the block so that connections are
+    reused across all the deliveries made inside it. Runs nest; only the
+    outermost block flushes and closes the backends.
+    """
+    backends = BackendRun(get_backends())
+    for backend in backends:
+        backend.open()
+    try:
+        yield backends
+    finally:
+        errors = []
+        for backend in backends:
+            try:
+                sent = backend.close()
+            except Exception as e:
+                errors.append(e)
+            else:
+                if sent is not None:
+                    label = get_backend_label(backend)
+                    backends.delivered[label] = backends.delivered.get(label, 0) + sent
+        if errors:
+            raise errors[0]
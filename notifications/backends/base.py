@@ -1,54 +1,253 @@
-from django.template import Context
-from django.template.loader import render_to_string
+from copy import copy
+from functools import partial
+
+from django.template import Context, TemplateDoesNotExist
+from django.template.loader import select_template
+from django.utils import translation
+from django.utils.translation import ugettext
 from django.contrib.sites.models import Site
 
 from notifications.conf import settings
 
 
+# default context data per site, shared by all backends of the process
+_default_contexts = {}
+
+
+def clear_default_context_cache(*args, **kwargs):
+    _default_contexts.clear()
+
+
+def run_in_executor(func):
+    import asyncio
+
+    return asyncio.get_event_loop().run_in_executor(None, func)
+
+
 class BaseBackend(object):
     """
     The base backend.
     """
+    # whether ``deliver`` takes a ``shared_context``; otherwise it is passed the
+    # caller's extra_context merged with the recipient's values
+    accepts_shared_context = False
+    # whether the backend counts its deliveries in the metrics itself
+    records_metrics = False
+    # whether the backend paces its transport to NOTIFICATIONS_RATE_LIMITS itself
+    throttles = False
+
     def __init__(self, medium_id, spam_sensitivity=None):
         self.medium_id = medium_id
         if spam_sensitivity is not None:
             self.spam_sensitivity = spam_sensitivity
+        self._templates = {}
+
+    def open(self):
+        """
+        Called before a run of deliveries. Backends holding a connection to
+        their transport should open it here and keep it for the whole run.
+        """
+        pass
+
+    def flush(self):
+        """
+        Sends anything the backend has buffered during the current run.
+        """
+        pass
+
+    def discard(self):
+        """
+        Drops anything the backend has buffered during the current run without
+        sending it, after the deliveries it belongs to failed.
+        """
+        pass
+
+    def close(self):
+        """
+        Called after a run of deliveries. Flushes buffered notifications and
+        releases whatever ``open`` acquired. Backends that count what they
+        send return the number of messages sent during the run when its
+        outermost block ends.
+        """
+        pass
 
     def can_send(self, user, notice_type, scoping):
         """
         Determines whether this backend is allowed to send a notification to
         the given user and notice_type.
         """
-        # return notice_setting_for_user(user, notice_type, self.medium_id, scoping).send
-        return True
+        from notifications.utils import notice_settings_for_users
+
+        return notice_settings_for_users([user], notice_type, self.medium_id, scoping)[user.pk]
+
+    def filter_can_send(self, users, notice_type, scoping):
+        """
+        Returns the users this backend is allowed to send a notification of the
+        given notice_type to, looking up their settings in bulk. Backends that
+        only override ``can_send`` have it applied to each user as well.
+        """
+        from notifications.utils import notice_settings_for_users
+
+        allowed = notice_settings_for_users(users, notice_type, self.medium_id, scoping)
+        users = [user for user in users if allowed[user.pk]]
+        if self._overrides_can_send():
+            users = [user for user in users if self.can_send(user, notice_type, scoping)]
+        return users
 
-    def deliver(self, recipient, sender, notice_type, extra_context):
+    def _overrides_can_send(self):
+        # whether can_send is overridden further down than filter_can_send,
+        # which then doesn't know about the override
+        for klass in type(self).__mro__:
+            if "filter_can_send" in vars(klass):
+                return False
+            if "can_send" in vars(klass):
+                return True
+        return False
+
+    def deliver(self, notice_type, extra_context, attachments, recipient_email, sender, shared_context=None):
         """
         Deliver a notification to the given recipient.
+
+        Backends setting ``accepts_shared_context`` are given a
+        ``shared_context`` (see ``get_shared_context``) holding everything
+        common to all recipients, and ``extra_context`` only holds the values
+        specific to this recipient.
         """
         raise NotImplementedError()
 
+    def _deliver_kwargs(self, shared_context):
+        if self.accepts_shared_context:
+            return {"shared_context": shared_context}
+        return {}
+
+    def deliver_bulk(self, notice_type, shared_context, recipients, attachments, sender):
+        """
+        Delivers a notification to many recipients at once. ``recipients`` is a
+        list of ``(recipient_email, extra_context)`` pairs, each
+        ``extra_context`` holding the values specific to its recipient, layered
+        over ``shared_context``. Backends whose transport takes many recipients
+        per call should override it; by default ``deliver`` is called for each.
+        """
+        kwargs = self._deliver_kwargs(shared_context)
+        for recipient_email, extra_context in recipients:
+            self.deliver(notice_type, extra_context, attachments, recipient_email, sender, **kwargs)
+
+    def build_message(self, notice_type, extra_context, attachments, recipient_email, sender, shared_context=None):
+        """
+        Prepares the notification for the recipient without sending it, for
+        ``send_messages`` to send later, possibly from another thread. Backends
+        that can should render here; by default the whole delivery is deferred
+        and made in the language active now.
+        """
+        if shared_context is not None:
+            # the shared context is pushed onto while rendering, so each message gets its own
+            shared_context = copy(shared_context)
+        return partial(self.deliver, notice_type, extra_context, attachments, recipient_email, sender,
+                       **self._deliver_kwargs(shared_context)), translation.get_language()
+
+    def send_messages(self, messages):
+        """
+        Sends messages made by ``build_message``. Returns how many were sent.
+        """
+        for deliver, language in messages:
+            with translation.override(language):
+                deliver()
+        return len(messages)
+
+    def adeliver(self, notice_type, extra_context, attachments, recipient_email, sender, shared_context=None):
+        """
+        Returns an awaitable delivering a notification, for use from asyncio.
+        Backends with an asynchronous transport can override it; by default
+        ``deliver`` runs in the event loop's executor.
+        """
+        return run_in_executor(partial(self.deliver, notice_type, extra_context, attachments, recipient_email,
+                                       sender, **self._deliver_kwargs(shared_context)))
+
+    def asend_messages(self, messages):
+        """
+        Returns an awaitable sending messages made by ``build_message``, which
+        resolves to how many were sent. By default ``send_messages`` runs in the
+        event loop's executor.
+        """
+        return run_in_executor(partial(self.send_messages, messages))
+
+    def adeliver_digest(self, users, notice_history):
+        """
+        Returns an awaitable delivering a digest. By default ``deliver_digest``
+        runs in the event loop's executor.
+        """
+        return run_in_executor(partial(self.deliver_digest, users, notice_history))
+
+    def get_template(self, format, label):
+        """
+        Returns the compiled template for the format, preferring the one specific
+        to the notice type label. Templates are looked up once per backend.
+        """
+        key = (label, format)
+        names = ("notifications/{0}/{1}".format(label, format), "notifications/{0}".format(format))
+        template = self._templates.get(key)
+        if template is None:
+            try:
+                template = select_template(names)
+            except TemplateDoesNotExist:
+                # remember missing templates too, they are looked for on every send
+                template = False
+            else:
+                # render with the engine's own Template so a Context can be passed in
+                template = getattr(template, "template", template)
+            self._templates[key] = template
+        if template is False:
+            raise TemplateDoesNotExist(", ".join(names))
+        return template
+
     def get_formatted_message(self, format, label, context):
         """
-        Returns a dictionary with the format identifier as the key. The values are
-        are fully rendered templates with the given context.
+        Returns the template for the format fully rendered with the given context.
         """
         # conditionally turn off autoescaping for .txt extensions in format
+        autoescape = context.autoescape
         if format.endswith(".txt"):
             context.autoescape = False
+        try:
+            return self.get_template(format, label).render(context)
+        finally:
+            context.autoescape = autoescape
 
-        format_template = render_to_string((
-            "notifications/{0}/{1}".format(label, format),
-            "notifications/{0}".format(format)), context_instance=context)
-        return format_template
+    def render(self, format, label, shared_context, recipient_context):
+        """
+        Renders the format with the recipient's values layered over the shared
+        context, leaving the shared context untouched for the next recipient.
+        """
+        shared_context.push(recipient_context)
+        try:
+            return self.get_formatted_message(format, label, shared_context)
+        finally:
+            shared_context.pop()
+
+    def get_shared_context(self, notice_type, extra_context, sender):
+        """
+        Returns the context common to every recipient of a notice, in the
+        currently active language.
+        """
+        context = self.default_context()
+        context.update({
+            "sender": sender,
+            "notice": ugettext(notice_type.display),
+        })
+        context.update(extra_context)
+        return context
 
     def default_context(self):
         use_ssl = getattr(settings, "USE_SSL", False)
-        default_http_protocol = "https" if use_ssl else "http"
-        current_site = Site.objects.get_current()
-        base_url = "{0}://{1}".format(default_http_protocol, current_site.domain)
-        return Context({
-            "default_http_protocol": default_http_protocol,
-            "current_site": current_site,
-            "base_url": base_url
-        })
+        key = (getattr(settings, "SITE_ID", None), use_ssl)
+        data = _default_contexts.get(key)
+        if data is None:
+            default_http_protocol = "https" if use_ssl else "http"
+            current_site = Site.objects.get_current()
+            base_url = "{0}://{1}".format(default_http_protocol, current_site.domain)
+            data = _default_contexts[key] = {
+                "default_http_protocol": default_http_protocol,
+                "current_site": current_site,
+                "base_url": base_url
+            }
+        return Context(data)
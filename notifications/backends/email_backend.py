@@ -1,19 +1,196 @@
 import os
 import re
+import time
+import socket
+import logging
+import smtplib
+import threading
+import mimetypes
+from functools import partial
+from contextlib import contextmanager
 from email.mime.image import MIMEImage
 
-from django.core.mail import EmailMultiAlternatives
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.template import TemplateDoesNotExist
 from django.template.loader import render_to_string
-from django.utils.translation import ugettext
+from django.utils.translation import ugettext, get_language
 from django.utils.html import strip_tags
 from django.contrib.sites.models import Site
 
 from notifications.backends.base import BaseBackend
+from notifications.cache import get_cache, get_file_cache
 from notifications.conf import settings
+from notifications.metrics import stage, record_delivery
+from notifications.ratelimit import batch_size, wait
+
+
+# errors the server answers a single message with; the other messages still go out
+MESSAGE_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError)
+
+
+def is_connection_error(error):
+    """
+    Returns whether the connection should be thrown away and opened again
+    after the error.
+    """
+    if isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+    # on Python 3 socket.error is OSError, which every SMTPException derives from
+    return isinstance(error, socket.error) and not isinstance(error, smtplib.SMTPException)
 
 
 class EmailBackend(BaseBackend):
     spam_sensitivity = 2
+    accepts_shared_context = True
+    records_metrics = True
+    throttles = True
+
+    def __init__(self, medium_id, spam_sensitivity=None):
+        super(EmailBackend, self).__init__(medium_id, spam_sensitivity)
+        # backends are shared by the whole process, so each thread gets its own run
+        self._run = threading.local()
+
+    def open(self):
+        run = self._run
+        if getattr(run, "depth", 0) == 0:
+            run.connection = None
+            run.outbox = []
+            run.sent = 0
+            run.depth = 0
+        run.depth += 1
+
+    def flush(self):
+        run = self._run
+        if not getattr(run, "depth", 0):
+            return
+        self._flush()
+
+    def discard(self):
+        run = self._run
+        if getattr(run, "depth", 0):
+            run.outbox = []
+
+    def _flush(self):
+        run = self._run
+        messages, run.outbox = run.outbox, []
+        size = batch_size(self, settings.NOTIFICATIONS_EMAIL_BATCH_SIZE)
+        for i in range(0, len(messages), size):
+            run.sent += self._send_batch(messages[i:i + size])
+
+    def close(self):
+        """
+        Returns the number of messages sent during the run when the outermost
+        run is closed.
+        """
+        run = self._run
+        if not getattr(run, "depth", 0):
+            return
+        run.depth -= 1
+        if run.depth > 0:
+            return
+        try:
+            self._flush()
+        finally:
+            self._close_connection()
+        logging.debug("{0} sent {1} messages".format(self.__class__.__name__, run.sent))
+        return run.sent
+
+    def send_messages(self, messages):
+        """
+        Sends the given email messages and returns how many were sent. Inside
+        a run they are buffered and sent over the run's connection in batches
+        of NOTIFICATIONS_EMAIL_BATCH_SIZE, and are counted once buffered;
+        outside of one they go out immediately over a single connection.
+        """
+        run = self._run
+        if not getattr(run, "depth", 0):
+            size = batch_size(self, len(messages))
+            if size >= len(messages):
+                wait(self, len(messages))
+                with self.sending(messages):
+                    return get_connection().send_messages(messages) or 0
+            # paced to the rate limit over a single connection
+            sent = 0
+            connection = get_connection()
+            connection.open()
+            try:
+                for i in range(0, len(messages), size):
+                    batch = messages[i:i + size]
+                    wait(self, len(batch))
+                    with self.sending(batch):
+                        sent += connection.send_messages(batch) or 0
+            finally:
+                connection.close()
+            return sent
+        run.outbox.extend(messages)
+        if len(run.outbox) >= settings.NOTIFICATIONS_EMAIL_BATCH_SIZE:
+            self._flush()
+        return len(messages)
+
+    def _send_batch(self, batch):
+        """
+        Sends the batch over the run's connection one message at a time, so
+        that after a reconnect only the messages not sent yet go out again.
+        Messages the server refuses are counted as failed and skipped. Returns
+        the number of messages sent.
+        """
+        run = self._run
+        sent, failed, attempts = 0, 0, 0
+        # reserved once, so a batch resumed after a reconnect doesn't use up the rate limit twice
+        wait(self, len(batch))
+        start = time.time()
+        index = 0
+        with stage("transport"):
+            try:
+                while index < len(batch):
+                    if run.connection is None:
+                        run.connection = get_connection()
+                        run.connection.open()
+                    message = batch[index]
+                    try:
+                        sent += run.connection.send_messages([message]) or 0
+                    except MESSAGE_ERRORS as e:
+                        logging.warning("email to {0} was refused: {1}".format(", ".join(message.recipients()), e))
+                        failed += 1
+                    except Exception as e:
+                        if not is_connection_error(e):
+                            raise
+                        self._close_connection()
+                        attempts += 1
+                        if attempts > settings.NOTIFICATIONS_EMAIL_RECONNECT_ATTEMPTS:
+                            raise
+                        logging.warning("email connection lost, reconnecting ({0})".format(attempts))
+                        continue
+                    index += 1
+            except Exception:
+                record_delivery(self, delivered=sent, failed=len(batch) - sent, seconds=time.time() - start)
+                raise
+        record_delivery(self, delivered=sent, failed=failed, seconds=time.time() - start)
+        return sent
+
+    @contextmanager
+    def sending(self, messages):
+        """
+        Times sending the messages and counts them as delivered or failed.
+        """
+        start = time.time()
+        with stage("transport"):
+            try:
+                yield
+            except Exception:
+                record_delivery(self, failed=len(messages), seconds=time.time() - start)
+                raise
+        record_delivery(self, delivered=len(messages), seconds=time.time() - start)
+
+    def _close_connection(self):
+        run = self._run
+        connection, run.connection = run.connection, None
+        if connection is not None:
+            try:
+                connection.close()
+            except (smtplib.SMTPException, socket.error):
+                # the connection is thrown away either way
+                pass
 
     def can_send(self, user, notice_type, scoping):
         can_send = super(EmailBackend, self).can_send(user, notice_type, scoping)
@@ -21,54 +198,99 @@ class EmailBackend(BaseBackend):
             return True
         return False
 
-    def deliver(self, notice_type, extra_context, attachments, recipient_email, sender=settings.DEFAULT_FROM_EMAIL):
-        context = self.default_context()
-        context.update({
-            "recipient_email": recipient_email,
-            "sender": sender,
-            "notice": ugettext(notice_type.display),
-        })
-        context.update(extra_context)
+    def filter_can_send(self, users, notice_type, scoping):
+        users = [user for user in users if user.email]
+        return super(EmailBackend, self).filter_can_send(users, notice_type, scoping)
 
-        subject = "".join(render_to_string("notifications/email_subject.txt", context).splitlines())
-        body = self.get_formatted_message("email_body.html", notice_type.label, context)
-        body_text = strip_tags(body)
+    def deliver(self, notice_type, extra_context, attachments, recipient_email, sender=settings.DEFAULT_FROM_EMAIL,
+                shared_context=None):
+        msg = self.build_message(notice_type, extra_context, attachments, recipient_email, sender, shared_context)
+        self.send_messages([msg])
 
-        msg = EmailMultiAlternatives(subject, body_text, sender, to=[recipient_email])
-        msg.attach_alternative(body, "text/html")
-        msg.mixed_subtype = "related"
+    def deliver_bulk(self, notice_type, shared_context, recipients, attachments,
+                     sender=settings.DEFAULT_FROM_EMAIL):
+        self.send_messages([
+            self.build_message(notice_type, extra_context, attachments, recipient_email, sender, shared_context)
+            for recipient_email, extra_context in recipients
+        ])
 
-        assets = notice_type.get_assets()
-        msg = self.add_assets(assets, msg)
+    def build_message(self, notice_type, extra_context, attachments, recipient_email,
+                      sender=settings.DEFAULT_FROM_EMAIL, shared_context=None):
+        with stage("render"):
+            if shared_context is None:
+                shared_context = self.get_shared_context(notice_type, extra_context, sender)
+                extra_context = {}
+            recipient_context = {"recipient_email": recipient_email}
+            recipient_context.update(extra_context)
 
-        for attachment in attachments:
-            msg.attach_file(attachment)
+            subject = "".join(self.render("email_subject.txt", notice_type.label,
+                                          shared_context, recipient_context).splitlines())
+            body = self.render("email_body.html", notice_type.label, shared_context, recipient_context)
+            body_text = strip_tags(body)
 
-        msg.send()
+            msg = EmailMultiAlternatives(subject, body_text, sender, to=[recipient_email])
+            msg.attach_alternative(body, "text/html")
+            msg.mixed_subtype = "related"
+
+            assets = notice_type.get_assets()
+            msg = self.add_assets(assets, msg)
+
+            msg = self.add_attachments(attachments, msg)
+
+            return msg
 
     def render_history(self, notice_history):
+        """
+        Returns ``(notice, html)`` pairs for the digest entries of the given
+        history. Each entry is rendered once per language and then served from
+        the cache configured by NOTIFICATIONS_DIGEST_CACHE.
+        """
+        cache = get_cache("digest_entries", settings.NOTIFICATIONS_DIGEST_CACHE,
+                          settings.NOTIFICATIONS_DIGEST_CACHE_SIZE)
+        language = get_language()
+        keys = [
+            (notice, "notifications:digest:{0}:{1}:{2}".format(notice.pk, notice.sent_at.isoformat(), language))
+            for notice in notice_history
+        ]
+        cached = cache.get_many([key for _, key in keys]) if cache is not None else {}
+
         renderings = []
-        for notice in notice_history:
-            context = self.default_context()
-            context.update({
-                "recipient": notice.recipient,
-                "sender": notice.sender,
-                "notice": ugettext(notice.notice_type.display),
-            })
-            context.update(notice.extra_context)
-
-            email_body = self.get_formatted_message("email_body.html", notice.notice_type.label, context)
-            html_body = re.findall(r"<body>\n((?:.+\n)*)</body>", email_body)
-            html_body = html_body[0]
+        rendered = {}
+        for notice, key in keys:
+            html_body = cached.get(key, rendered.get(key))
+            if html_body is None:
+                html_body = rendered[key] = self.render_digest_entry(notice)
             renderings.append((notice, html_body))
-
+        if cache is not None and rendered:
+            cache.set_many(rendered, settings.NOTIFICATIONS_DIGEST_CACHE_TIMEOUT)
         return renderings
 
+    def render_digest_entry(self, notice):
+        """
+        Renders the ``digest_entry.html`` fragment of the notice type. Notice
+        types without one get the body of their ``email_body.html`` instead.
+        """
+        context = self.default_context()
+        context.update({
+            "recipient": notice.recipient,
+            "sender": notice.sender,
+            "notice": ugettext(notice.notice_type.display),
+        })
+        context.update(notice.get_extra_context())
+
+        label = notice.notice_type.label
+        try:
+            return self.get_template("digest_entry.html", label).render(context)
+        except TemplateDoesNotExist:
+            email_body = self.get_formatted_message("email_body.html", label, context)
+            return re.findall(r"<body>\n((?:.+\n)*)</body>", email_body)[0]
+
     def deliver_digest(self, users, notice_history):
-        rendered_history = self.render_history(notice_history)
-        digest_body = render_to_string(["notifications/custom/digest.html", "notifications/digest.html"],
-                                       {'notice_history': rendered_history})
-        digest_text = strip_tags(digest_body)
+        with stage("render"):
+            rendered_history = self.render_history(notice_history)
+            digest_body = render_to_string(["notifications/custom/digest.html", "notifications/digest.html"],
+                                           {'notice_history': rendered_history})
+            digest_text = strip_tags(digest_body)
         digest_subject = "Digest from " + Site.objects.get_current().domain
 
         emails = []
@@ -85,14 +307,43 @@ class EmailBackend(BaseBackend):
         asset_set = set(asset_list)
         msg = self.add_assets(asset_set, msg)
 
-        msg.send()
+        self.send_messages([msg])
 
     def add_assets(self, asset_set, msg):
+        """
+        Attaches the inline images of the notice. The image parts are built once
+        per file and shared by every message.
+        """
+        file_cache = get_file_cache(settings.NOTIFICATIONS_FILE_CACHE_MAX_BYTES)
         for asset in asset_set:
             path = os.path.join(settings.STATIC_ROOT, "notifications", asset)
-            fp = open(path, 'rb')
-            msg_img = MIMEImage(fp.read())
-            fp.close()
-            msg_img.add_header('Content-ID', '<{}>'.format(asset))
-            msg.attach(msg_img)
+            msg.attach(file_cache.get(path, partial(make_inline_image, asset)))
+        return msg
+
+    def add_attachments(self, attachments, msg):
+        """
+        Attaches the files at the given paths, reading each file once while it
+        stays unchanged.
+        """
+        file_cache = get_file_cache(settings.NOTIFICATIONS_FILE_CACHE_MAX_BYTES)
+        for path in attachments:
+            filename = os.path.basename(path)
+            msg.attach(*file_cache.get(path, partial(make_attachment, filename)))
         return msg
+
+
+def make_inline_image(asset, data):
+    msg_img = MIMEImage(data)
+    msg_img.add_header('Content-ID', '<{}>'.format(asset))
+    return msg_img
+
+
+def make_attachment(filename, data):
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    if mimetype.startswith("text/"):
+        # MIMEText wants text; files that aren't UTF-8 go out as binary
+        try:
+            data = data.decode("utf-8")
+        except UnicodeDecodeError:
+            mimetype = "application/octet-stream"
+    return filename, data, mimetype
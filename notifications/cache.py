@@ -0,0 +1,136 @@
+import os
+import threading
+from collections import OrderedDict
+
+from django.core.cache import caches
+
+
+class LRUCache(object):
+    """
+    A small thread-safe least-recently-used cache local to the process. It
+    implements the subset of the Django cache API used by notifications.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def get_many(self, keys):
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def set_many(self, data, timeout=None):
+        for key, value in data.items():
+            self.set(key, value)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class FileCache(object):
+    """
+    Keeps values built from the bytes of files, keyed by path and modification
+    time so edited files are read again. The files' sizes add up to at most
+    ``max_bytes``; the least recently used are dropped to make room and larger
+    files are not kept at all.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path, build):
+        """
+        Returns ``build(data)`` for the contents of the file at ``path``.
+        """
+        mtime = os.stat(path).st_mtime
+        with self._lock:
+            entry = self._data.pop(path, None)
+            if entry is not None:
+                if entry[0] == mtime:
+                    self._data[path] = entry
+                    return entry[2]
+                self.size -= entry[1]
+        with open(path, "rb") as fp:
+            data = fp.read()
+        value = build(data)
+        if len(data) <= self.max_bytes:
+            with self._lock:
+                previous = self._data.pop(path, None)
+                if previous is not None:
+                    self.size -= previous[1]
+                self._data[path] = (mtime, len(data), value)
+                self.size += len(data)
+                while self.size > self.max_bytes:
+                    _, (_, size, _) = self._data.popitem(last=False)
+                    self.size -= size
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+
+_local_caches = {}
+_local_caches_lock = threading.Lock()
+
+
+def get_cache(name, alias, max_size):
+    """
+    Returns the cache configured by ``alias``: None when caching is disabled,
+    a process-local LRUCache of ``max_size`` entries for "local", or else the
+    Django cache with that alias. Local caches are shared per ``name``.
+    """
+    if not alias:
+        return None
+    if alias != "local":
+        return caches[alias]
+    with _local_caches_lock:
+        cache = _local_caches.get(name)
+        if cache is None or cache.max_size != max_size:
+            cache = _local_caches[name] = LRUCache(max_size)
+        return cache
+
+
+_file_cache = None
+
+
+def get_file_cache(max_bytes):
+    """
+    Returns the process-wide FileCache.
+    """
+    global _file_cache
+    with _local_caches_lock:
+        if _file_cache is None or _file_cache.max_bytes != max_bytes:
+            _file_cache = FileCache(max_bytes)
+        return _file_cache
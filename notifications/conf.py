@@ -42,10 +42,37 @@ def is_installed(package):
 
 
 class NotificationsAppConf(AppConf):
-    LOCK_WAIT_TIMEOUT = -1
+    LEASE_SECONDS = 300
+    DIGEST_CACHE = "local"
+    DIGEST_CACHE_SIZE = 10000
+    DIGEST_CACHE_TIMEOUT = 86400
+    FILE_CACHE_MAX_BYTES = 16 * 1024 * 1024
+    HISTORY_BUFFER_SIZE = 1000
+    HISTORY_FLUSH_INTERVAL = 5
+    HISTORY_DISABLED_TYPES = []
+    QUEUE_BATCH_SIZE = 1000
+    QUEUE_CHUNK_SIZE = 100
+    QUEUE_MAX_ATTEMPTS = 5
+    QUEUE_RETRY_DELAY = 60
+    EMITTER_MIN_INTERVAL = 0.5
+    EMITTER_MAX_INTERVAL = 5
     GET_LANGUAGE_MODEL = None
     LANGUAGE_MODEL = None
     QUEUE_ALL = False
+    RECIPIENT_CHUNK_SIZE = 500
+    DELIVERY_WORKERS = 0
+    DELIVERY_LIMITS = {}
+    DELIVERY_CHUNK_SIZE = 50
+    RATE_LIMITS = {}
+    RATE_LIMIT_CACHE = None
+    ASYNC_WORKERS = 4
+    METRICS_SINK = "notifications.metrics.InMemorySink"
+    EMAIL_BATCH_SIZE = 100
+    EMAIL_RECONNECT_ATTEMPTS = 1
+    TYPE_CACHE = None
+    SETTINGS_CACHE = None
+    SETTINGS_CACHE_SIZE = 10000
+    SETTINGS_CACHE_TIMEOUT = 300
     BACKENDS = [
         ("email", "notifications.backends.email_backend.EmailBackend"),
     ]
@@ -73,6 +100,13 @@ class NotificationsAppConf(AppConf):
         if value is None:
             return load_path_attr(settings.NOTIFICATIONS_DEFAULT_BACKEND)(0, None)
 
+    def configure_delivery_workers(self, value):
+        if value and not is_installed("concurrent.futures"):
+            raise ImproperlyConfigured(
+                "NOTIFICATIONS_DELIVERY_WORKERS requires the futures package on Python 2."
+            )
+        return value
+
     def configure_get_language_model(self, value):
         if value is None:
             return lambda: load_model(settings.NOTIFICATIONS_LANGUAGE_MODEL)
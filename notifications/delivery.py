@@ -0,0 +1,118 @@
+import time
+import threading
+from collections import OrderedDict
+
+from notifications.backends import get_backend_label
+from notifications.conf import settings
+from notifications.metrics import record_delivery
+from notifications.ratelimit import batch_size, throttle
+
+
+_executor = None
+_semaphores = {}
+_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Returns the thread pool the process sends notifications from, with
+    NOTIFICATIONS_DELIVERY_WORKERS threads.
+    """
+    global _executor
+    from concurrent.futures import ThreadPoolExecutor
+
+    workers = settings.NOTIFICATIONS_DELIVERY_WORKERS
+    with _lock:
+        if _executor is None or _executor[0] != workers:
+            if _executor is not None:
+                _executor[1].shutdown(wait=False)
+            _executor = (workers, ThreadPoolExecutor(workers))
+        return _executor[1]
+
+
+def get_semaphore(backend):
+    """
+    Returns the semaphore limiting how many threads send through the backend at
+    once, or None if NOTIFICATIONS_DELIVERY_LIMITS doesn't limit it.
+    """
+    limit = settings.NOTIFICATIONS_DELIVERY_LIMITS.get(get_backend_label(backend))
+    key = (id(backend), limit)
+    with _lock:
+        if key not in _semaphores:
+            _semaphores[key] = threading.BoundedSemaphore(limit) if limit else None
+        return _semaphores[key]
+
+
+def send_chunk(backend, messages):
+    throttle(backend, len(messages))
+    semaphore = get_semaphore(backend)
+    if semaphore is None:
+        return send_messages(backend, messages)
+    with semaphore:
+        return send_messages(backend, messages)
+
+
+def send_messages(backend, messages):
+    if getattr(backend, "records_metrics", False):
+        return backend.send_messages(messages)
+    start = time.time()
+    try:
+        sent = backend.send_messages(messages)
+    except Exception:
+        record_delivery(backend, failed=len(messages), seconds=time.time() - start)
+        raise
+    record_delivery(backend, delivered=len(messages), seconds=time.time() - start)
+    return sent
+
+
+class Dispatcher(object):
+    """
+    Sends the messages of a delivery from the thread pool while the calling
+    thread goes on rendering. Messages are handed over in chunks of
+    NOTIFICATIONS_DELIVERY_CHUNK_SIZE per backend, or of the burst of its rate
+    limit if smaller; ``wait`` blocks until all of them have been sent.
+    """
+    def __init__(self):
+        self.executor = get_executor()
+        self.chunk_size = settings.NOTIFICATIONS_DELIVERY_CHUNK_SIZE
+        # bounds the chunks waiting for a thread, so rendering doesn't run far ahead
+        self.slots = threading.BoundedSemaphore(2 * settings.NOTIFICATIONS_DELIVERY_WORKERS)
+        self.pending = OrderedDict()
+        self.futures = []
+
+    def add(self, backend, recipient, message):
+        chunk = self.pending.setdefault(backend, [])
+        chunk.append((recipient, message))
+        if len(chunk) >= batch_size(backend, self.chunk_size):
+            self.submit(backend)
+
+    def submit(self, backend):
+        chunk = self.pending.pop(backend, None)
+        if not chunk:
+            return
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(send_chunk, backend, [message for _, message in chunk])
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda future: self.slots.release())
+        self.futures.append((future, [recipient for recipient, _ in chunk]))
+
+    def wait(self):
+        """
+        Sends the messages still pending and waits for every chunk. Returns the
+        set of recipients whose messages were sent and the list of errors
+        raised by the chunks that failed.
+        """
+        for backend in list(self.pending):
+            self.submit(backend)
+        sent, errors = set(), []
+        for future, recipients in self.futures:
+            error = future.exception()
+            if error is None:
+                sent.update(recipients)
+            else:
+                errors.append(error)
+        self.futures = []
+        return sent, errors
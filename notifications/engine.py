@@ -1,112 +1,350 @@
+import os
 import sys
 import time
+import uuid
+import socket
 import logging
+import warnings
 import traceback
-import base64
-
-from lockfile import FileLock, AlreadyLocked, LockTimeout
+from collections import OrderedDict
 
+from django.db import close_old_connections
 from django.utils import timezone
 from django.core.mail import mail_admins
-from django.contrib.auth import get_user_model
 from django.contrib.sites.models import Site
 
-from six.moves import cPickle as pickle
-from notifications.models import NoticeQueueBatch, send_now, NoticeHistory, DigestSubscription
-from notifications.signals import emitted_notices
+from notifications.models import (
+    NoticeType, NoticeQueueBatch, NoticeHistory, NoticeThrough, DigestSubscription,
+    deliver_notice,
+)
+from notifications.backends import open_backends
+from notifications.history import buffered_history, flush_history, discard_history
+from notifications.metrics import collect_stages, stage, delivering
+from notifications.ratelimit import throttle
+from notifications.signals import emitted_notices, digests_sent
+from notifications.utils import chunked, get_users_for_recipients
 from notifications.conf import settings
 
 
-def acquire_lock(*args):
-    if len(args) == 1:
-        lock = FileLock(args[0])
-    else:
-        lock = FileLock("send_notices")
+class LeaseLost(Exception):
+    pass
 
-    logging.debug("acquiring lock...")
-    try:
-        lock.acquire(settings.NOTIFICATIONS_LOCK_WAIT_TIMEOUT)
-    except AlreadyLocked:
-        logging.debug("lock already in place. quitting.")
-        return
-    except LockTimeout:
-        logging.debug("waiting for the lock timed out. quitting.")
-        return
-    logging.debug("acquired")
-    return lock
-
-
-def send_all(*args):
-    lock = acquire_lock(*args)
+
+def get_worker_id():
+    """
+    Returns an identifier for this emitter, unique across hosts and processes.
+    """
+    return "{0}:{1}:{2}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+def group_notices(notices):
+    """
+    Yields ``(recipients, label, extra_context, sender, attachments)`` for each
+    run of consecutive notices that only differ in their recipient.
+    """
+    group = None
+    for recipient, label, extra_context, sender, attachments in notices:
+        if group is not None and group[1:] == (label, extra_context, sender, attachments):
+            group[0].append(recipient)
+        else:
+            if group is not None:
+                yield group
+            group = ([recipient], label, extra_context, sender, attachments)
+    if group is not None:
+        yield group
+
+
+def emit_batch(queued_batch, backends):
+    """
+    Emits the notices of a claimed batch from its last checkpoint on. Notices
+    are taken NOTIFICATIONS_QUEUE_CHUNK_SIZE at a time, and the recipients of
+    a chunk sharing a notice are sent it together, with one history record.
+    Progress is recorded after each such group, once it has been flushed out
+    of the backends, so a failure or crash never repeats a group that was
+    sent. Returns the number of notices processed and the number actually
+    sent.
+    """
+    sent, sent_actual = 0, 0
+    notices = queued_batch.get_notices()
+    chunk_size = settings.NOTIFICATIONS_QUEUE_CHUNK_SIZE
+    for start in range(queued_batch.position, len(notices), chunk_size):
+        chunk = notices[start:start + chunk_size]
+        position = start
+        with stage("resolve"):
+            users = get_users_for_recipients(notice[0] for notice in chunk)
+        for recipients, label, extra_context, sender, attachments in group_notices(chunk):
+            user_list = []
+            for recipient in recipients:
+                user = users.get(recipient)
+                if user is None:
+                    # Ignore deleted users, just warn about them
+                    logging.warning(
+                        "not emitting notice {0} to user {1} since it does not exist".format(label, recipient)
+                    )
+                else:
+                    user_list.append(user)
+            if user_list:
+                logging.info("emitting notice {0} to {1} users".format(label, len(user_list)))
+                sent_actual += len(deliver_notice(user_list, label, extra_context, sender,
+                                                  attachments=attachments))
+            sent += len(recipients)
+            position += len(recipients)
+            with stage("transport"):
+                for backend in backends:
+                    backend.flush()
+            flush_history()
+            if not queued_batch.checkpoint(position):
+                raise LeaseLost(queued_batch)
+    return sent, sent_actual
+
+
+def send_all(*args, **kwargs):
+    """
+    Emits the queued notices that are due, most urgent priority first.
+    Batches are claimed one at a time with a lease, so any number of workers
+    on any number of hosts can drain the queue together. A batch whose worker
+    died is picked up again once its lease expires, and resumes from its last
+    checkpoint. A batch that fails is retried on later runs until it runs out
+    of attempts. Once the ``stop`` event is set no further batch is claimed.
+    With ``max_priority`` only batches with a priority of at most that are
+    emitted. Returns the number of batches emitted.
+
+    Takes ``worker_id``, ``stop`` and ``max_priority`` as keyword arguments.
+    The lock file path older releases took is ignored.
+    """
+    worker_id = kwargs.pop("worker_id", None)
+    stop = kwargs.pop("stop", None)
+    max_priority = kwargs.pop("max_priority", None)
+    if kwargs:
+        raise TypeError("send_all() got an unexpected keyword argument '{0}'".format(sorted(kwargs)[0]))
+    if args:
+        warnings.warn(
+            "send_all() no longer takes a lock file path, batches are claimed with leases; it is ignored.",
+            DeprecationWarning, stacklevel=2
+        )
+    if worker_id is None:
+        worker_id = get_worker_id()
     batches, sent, sent_actual = 0, 0, 0
     start_time = time.time()
 
-    if lock is not None:
-        try:
-            for queued_batch in NoticeQueueBatch.objects.all():
-                if queued_batch.send_at is None or queued_batch.send_at < timezone.now():
-                    notices = pickle.loads(base64.b64decode(queued_batch.pickled_data))
-                    for user, label, extra_context, sender, attachments in notices:
-                        try:
-                            user = get_user_model().objects.get(email=user)
-                            logging.info("emitting notice {0} to {1}".format(label, user))
-                            # call this once per user to be atomic and allow for logging to
-                            # accurately show how long each takes.
-                            if send_now(users=[user], label=label, extra_context=extra_context,
-                                        sender=sender, attachments=attachments):
-                                sent_actual += 1
-                        except get_user_model().DoesNotExist:
-                            # Ignore deleted users, just warn about them
-                            logging.warning(
-                                "not emitting notice {0} to user {1} since it does not exist".format(label, user)
-                            )
-                        sent += 1
+    try:
+        with collect_stages() as stages, open_backends() as backends, buffered_history():
+            # batches that failed or were lost in this run, and are left to later runs
+            skipped = set()
+            preempted = True
+            while preempted:
+                preempted = False
+                now = timezone.now()
+                pending = NoticeQueueBatch.objects.lanes(max_priority).due(now).claimable(now).exclude(pk__in=skipped)
+                # stream only the due work, so memory and I/O do not grow with the scheduled backlog
+                for queued_batch in pending.iterator():
+                    if stop is not None and stop.is_set():
+                        break
+                    if not queued_batch.claim(worker_id):
+                        logging.debug("batch {0} is claimed by another worker".format(queued_batch.pk))
+                        continue
+                    try:
+                        batch_sent, batch_sent_actual = emit_batch(queued_batch, backends)
+                    except LeaseLost:
+                        logging.warning("lost the lease on batch {0}, leaving it".format(queued_batch.pk))
+                        skipped.add(queued_batch.pk)
+                        continue
+                    except Exception:
+                        _, e, _ = sys.exc_info()
+                        message = "\n".join(traceback.format_exception(*sys.exc_info()))
+                        # what the failed group left unflushed is retried from the checkpoint
+                        for backend in backends:
+                            backend.discard()
+                        discard_history()
+                        if queued_batch.fail(message):
+                            report_exception("batch {0} failed for good: {1}".format(queued_batch.pk, e), message)
+                        else:
+                            logging.error("batch {0} failed, will retry: {1}".format(queued_batch.pk, e))
+                        skipped.add(queued_batch.pk)
+                        continue
+                    sent += batch_sent
+                    sent_actual += batch_sent_actual
                     queued_batch.delete()
                     batches += 1
-            emitted_notices.send(
-                sender=NoticeQueueBatch,
-                batches=batches,
-                sent=sent,
-                sent_actual=sent_actual,
-                run_time="%.2f seconds" % (time.time() - start_time)
-            )
-        except Exception:
-            # get the exception
-            _, e, _ = sys.exc_info()
-            # email people
-            current_site = Site.objects.get_current()
-            subject = "[{0} emit_notices] {1}".format(current_site.name, e)
-            message = "\n".join(
-                traceback.format_exception(*sys.exc_info())
-            )
-            mail_admins(subject, message, fail_silently=True)
-            # log it as critical
-            logging.critical("an exception occurred: {0}".format(e))
-        finally:
-            logging.debug("releasing lock...")
-            lock.release()
-            logging.debug("released")
-    else:
-        pass
+                    # go back for more urgent batches queued or come due since the run started
+                    now = timezone.now()
+                    if NoticeQueueBatch.objects.lanes(max_priority).due(now).claimable(now).filter(
+                            priority__lt=queued_batch.priority).exclude(pk__in=skipped).exists():
+                        preempted = True
+                        break
+        emitted_notices.send(
+            sender=NoticeQueueBatch,
+            batches=batches,
+            sent=sent,
+            sent_actual=sent_actual,
+            delivered=sum(backends.delivered.values()),
+            run_time="%.2f seconds" % (time.time() - start_time),
+            stages=stages
+        )
+    except Exception:
+        # get the exception
+        _, e, _ = sys.exc_info()
+        report_exception(e, "\n".join(traceback.format_exception(*sys.exc_info())))
 
     logging.info("")
-    logging.info("{0} batches, {1} sent".format(batches, sent,))
+    logging.info("{0} batches, {1} sent".format(batches, sent))
     logging.info("done in {0:.2f} seconds".format(time.time() - start_time))
+    return batches
+
+
+def run_emitter(stop, worker_id=None, max_priority=None):
+    """
+    Emits queued notices as they become due until the ``stop`` event is set.
+    Between runs it sleeps until the next batch is due, but polls for new
+    batches at least every NOTIFICATIONS_EMITTER_MAX_INTERVAL seconds. The
+    poll interval starts at NOTIFICATIONS_EMITTER_MIN_INTERVAL and doubles
+    while the queue stays idle. With ``max_priority`` only batches with a
+    priority of at most that are emitted, reserving the emitter for the
+    urgent lanes.
+    """
+    if worker_id is None:
+        worker_id = get_worker_id()
+    min_interval = settings.NOTIFICATIONS_EMITTER_MIN_INTERVAL
+    max_interval = settings.NOTIFICATIONS_EMITTER_MAX_INTERVAL
+    interval = min_interval
+    while not stop.is_set():
+        timeout = interval
+        try:
+            # a long running process outlives database connections
+            close_old_connections()
+            now = timezone.now()
+            batches = NoticeQueueBatch.objects.lanes(max_priority)
+            if (batches.due(now).claimable(now).exists() and
+                    send_all(worker_id=worker_id, stop=stop, max_priority=max_priority)):
+                interval = min_interval
+                continue
+            next_due = batches.next_due(now)
+            if next_due is not None:
+                timeout = min(timeout, max(0, (next_due - timezone.now()).total_seconds()))
+        except Exception:
+            # the database may be restarting or failing over, try again later
+            logging.exception("emitting notices failed, retrying in {0:.1f} seconds".format(timeout))
+        interval = min(interval * 2, max_interval)
+        stop.wait(timeout)
+
+
+def report_exception(error, message):
+    # email people
+    current_site = Site.objects.get_current()
+    subject = "[{0} emit_notices] {1}".format(current_site.name, error)
+    mail_admins(subject, message, fail_silently=True)
+    # log it as critical
+    logging.critical("an exception occurred: {0}".format(error))
 
 
 def send_subscriptions():
-    digest_subs = DigestSubscription.objects.filter(emit_at__lte=timezone.now())
+    """
+    Sends the digests of every due DigestSubscription. A user's due
+    subscriptions with the same frequency are merged into a single digest of
+    the notices the user received within that window. Sends the
+    ``digests_sent`` signal once done.
+    """
+    with collect_stages() as stages:
+        digests = _send_subscriptions()
+    digests_sent.send(sender=DigestSubscription, digests=digests, stages=stages)
+
+
+def _send_subscriptions():
+    now = timezone.now()
+    with stage("resolve"):
+        digest_subs = list(DigestSubscription.objects.filter(emit_at__lte=now).select_related("user"))
+        notice_history = collect_subscription_notifications(digest_subs, now)
+
+    groups = OrderedDict()
+    by_frequency = {}
     for digest_sub in digest_subs:
-        if digest_sub.is_ready():
-            digest_sub.emit_at = timezone.now() + timezone.timedelta(minutes=digest_sub.frequency)
-            digest_sub.save()
-            send_digest([digest_sub.user], [digest_sub.notice_type], minutes=digest_sub.frequency)
+        groups.setdefault((digest_sub.user_id, digest_sub.frequency), []).append(digest_sub)
+        by_frequency.setdefault(digest_sub.frequency, []).append(digest_sub.pk)
+    for frequency, pks in by_frequency.items():
+        DigestSubscription.objects.filter(pk__in=pks).update(
+            emit_at=now + timezone.timedelta(minutes=frequency)
+        )
+
+    with open_backends(), buffered_history():
+        for subs in groups.values():
+            history = dict(
+                (notice.pk, notice) for digest_sub in subs for notice in notice_history[digest_sub.pk]
+            )
+            history = sorted(history.values(), key=lambda notice: (notice.sent_at, notice.pk))
+            deliver_digest([subs[0].user], history)
+    return len(groups)
 
 
 def send_digest(users, notice_types, **kwargs):
-    notice_history = collect_notifications(notice_types, **kwargs)
+    with collect_stages() as stages:
+        with stage("resolve"):
+            notice_history = list(collect_notifications(notice_types, **kwargs))
+        deliver_digest(users, notice_history)
+    digests_sent.send(sender=DigestSubscription, digests=1, stages=stages)
+
+
+def deliver_digest(users, notice_history):
+    notice_history = attach_notice_types(notice_history)
     for backend in settings.NOTIFICATIONS_BACKENDS.values():
-        backend.deliver_digest(users, notice_history)
+        throttle(backend, len(users))
+        with delivering(backend, len(users)):
+            backend.deliver_digest(users, notice_history)
+
+
+def collect_subscription_notifications(digest_subs, now=None):
+    """
+    Returns a dictionary mapping the primary key of each subscription to the
+    history of the notices of its type sent to its user within its window,
+    oldest first. The history of all the subscriptions is fetched together,
+    through NoticeThrough, with one query per NOTIFICATIONS_RECIPIENT_CHUNK_SIZE
+    users.
+    """
+    if now is None:
+        now = timezone.now()
+    collected = dict((digest_sub.pk, []) for digest_sub in digest_subs)
+    if not digest_subs:
+        return collected
+    windows = dict(
+        (digest_sub.pk, now - timezone.timedelta(minutes=digest_sub.frequency)) for digest_sub in digest_subs
+    )
+    type_ids = {}
+    for digest_sub in digest_subs:
+        try:
+            type_ids[digest_sub.notice_type] = NoticeType.objects.get_for_label(digest_sub.notice_type).pk
+        except NoticeType.DoesNotExist:
+            pass
+    if not type_ids:
+        return collected
+    user_ids = set(digest_sub.user_id for digest_sub in digest_subs)
+
+    history_by_user = {}
+    for chunk in chunked(user_ids, settings.NOTIFICATIONS_RECIPIENT_CHUNK_SIZE):
+        throughs = NoticeThrough.objects.filter(
+            user__in=chunk,
+            history__sent_at__gte=min(windows.values()),
+            history__notice_type__in=set(type_ids.values()),
+        ).select_related("history").order_by("history__sent_at", "history")
+        for through in throughs:
+            history_by_user.setdefault(through.user_id, []).append(through.history)
+
+    for digest_sub in digest_subs:
+        type_id = type_ids.get(digest_sub.notice_type)
+        collected[digest_sub.pk] = attach_notice_types([
+            history for history in history_by_user.get(digest_sub.user_id, [])
+            if history.notice_type_id == type_id and history.sent_at >= windows[digest_sub.pk]
+        ])
+    return collected
+
+
+def attach_notice_types(notice_history):
+    """
+    Sets the notice type of each NoticeHistory from the NoticeType cache rather
+    than loading it from the database, and returns them as a list.
+    """
+    notice_history = list(notice_history)
+    for notice in notice_history:
+        notice.notice_type = NoticeType.objects.get_for_id(notice.notice_type_id)
+    return notice_history
 
 
 def collect_notifications(notice_types='__all__', days=0, seconds=0, microseconds=0,
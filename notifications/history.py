@@ -0,0 +1,137 @@
+import time
+import base64
+import json
+import threading
+from contextlib import contextmanager
+
+from django.db import connections, router, transaction
+from django.utils import timezone
+
+from six.moves import cPickle
+from notifications.conf import settings
+from notifications.metrics import stage
+
+
+class HistoryRecorder(object):
+    """
+    Records sent notices as NoticeHistory rows and their recipients as
+    NoticeThrough rows. Outside of a buffering block every notice is written
+    right away; inside one they are kept in memory and written in bulk once
+    NOTIFICATIONS_HISTORY_BUFFER_SIZE recipients or
+    NOTIFICATIONS_HISTORY_FLUSH_INTERVAL seconds have been reached, and when
+    the outermost block ends. Buffers are kept per thread.
+    """
+    def __init__(self):
+        self._local = threading.local()
+
+    def _state(self):
+        state = self._local
+        if not hasattr(state, "depth"):
+            state.depth = 0
+            state.pending = []
+            state.size = 0
+            state.started_at = None
+        return state
+
+    def start(self):
+        self._state().depth += 1
+
+    def stop(self):
+        state = self._state()
+        if state.depth > 0:
+            state.depth -= 1
+        if state.depth == 0:
+            self.flush()
+
+    @contextmanager
+    def buffering(self):
+        self.start()
+        try:
+            yield self
+        finally:
+            self.stop()
+
+    def record(self, notice_type, sender, extra_context, attachments, users):
+        """
+        Records that the notice was sent to the given users, unless history is
+        disabled for its type through NOTIFICATIONS_HISTORY_DISABLED_TYPES.
+        """
+        if notice_type.label in settings.NOTIFICATIONS_HISTORY_DISABLED_TYPES:
+            return
+        with stage("history"):
+            self._record(notice_type, sender, extra_context, attachments, users)
+
+    def _record(self, notice_type, sender, extra_context, attachments, users):
+        from notifications.models import NoticeHistory
+
+        history = NoticeHistory(notice_type=notice_type, sender=sender,
+                                extra_context=base64.b64encode(cPickle.dumps(extra_context)),
+                                attachments=json.dumps(attachments),
+                                sent_at=timezone.now())
+        state = self._state()
+        if not state.pending:
+            state.started_at = time.time()
+        state.pending.append((history, [user.pk for user in users]))
+        state.size += 1 + len(users)
+        if (state.depth == 0 or
+                state.size >= settings.NOTIFICATIONS_HISTORY_BUFFER_SIZE or
+                time.time() - state.started_at >= settings.NOTIFICATIONS_HISTORY_FLUSH_INTERVAL):
+            self.flush()
+
+    def flush(self):
+        """
+        Writes every buffered history record and its recipients.
+        """
+        state = self._state()
+        pending, state.pending, state.size = state.pending, [], 0
+        if not pending:
+            return
+        with stage("history"):
+            self._write(pending)
+
+    def discard(self):
+        """
+        Drops the buffered history records without writing them.
+        """
+        state = self._state()
+        state.pending, state.size = [], 0
+
+    def _write(self, pending):
+        from notifications.models import NoticeHistory, NoticeThrough
+
+        histories = [history for history, _ in pending]
+        using = router.db_for_write(NoticeHistory)
+        with transaction.atomic(using=using):
+            if getattr(connections[using].features, "can_return_ids_from_bulk_insert", False):
+                NoticeHistory.objects.using(using).bulk_create(histories)
+            else:
+                # without ids coming back from a bulk insert the recipients can't be linked
+                for history in histories:
+                    history.save(using=using)
+            NoticeThrough.objects.using(using).bulk_create([
+                NoticeThrough(user_id=user_id, history=history)
+                for history, user_ids in pending
+                for user_id in user_ids
+            ])
+
+
+recorder = HistoryRecorder()
+
+
+def record_history(notice_type, sender, extra_context, attachments, users):
+    recorder.record(notice_type, sender, extra_context, attachments, users)
+
+
+def buffered_history():
+    """
+    Buffers the history written inside the block and writes it in bulk.
+    """
+    return recorder.buffering()
+
+
+def flush_history():
+    recorder.flush()
+
+
+def discard_history():
+    recorder.discard()
@@ -1,13 +1,47 @@
+import signal
 import logging
+import warnings
+import threading
 
 from django.core.management.base import BaseCommand
 
-from notifications.engine import send_all
+from notifications.engine import send_all, run_emitter
 
 
 class Command(BaseCommand):
     help = "Emit queued notices."
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "args", nargs="*",
+            help="Ignored, the lock file path older releases took. Batches are claimed with leases instead."
+        )
+        parser.add_argument(
+            "--daemon", action="store_true", dest="daemon", default=False,
+            help="Keep running and emit notices as they become due, until SIGTERM or SIGINT."
+        )
+        parser.add_argument(
+            "--max-priority", type=int, dest="max_priority", default=None,
+            help="Only emit notices queued with a priority of at most this."
+        )
+
     def handle(self, *args, **options):
         logging.basicConfig(level=logging.DEBUG, format="%(message)s")
-        send_all(*args)
+        if args:
+            warnings.warn(
+                "emit_notices no longer takes a lock file path, batches are claimed with leases; it is ignored.",
+                DeprecationWarning
+            )
+        if not options["daemon"]:
+            send_all(max_priority=options["max_priority"])
+            return
+
+        stop = threading.Event()
+
+        def shutdown(signum, frame):
+            logging.info("stopping once the current batch is done")
+            stop.set()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+        run_emitter(stop, max_priority=options["max_priority"])
@@ -0,0 +1,173 @@
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from notifications.backends import get_backend_label
+from notifications.conf import settings, load_path_attr
+
+
+# the stages the time of sending notices is broken down into
+STAGES = ("resolve", "preferences", "render", "throttle", "transport", "history")
+
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+
+class MetricsSink(object):
+    """
+    Receives the measurements taken while sending notices. Subclass it to
+    forward them to statsd, Prometheus and the like, and point
+    NOTIFICATIONS_METRICS_SINK to the subclass.
+    """
+    def timing(self, name, seconds, tags=None):
+        pass
+
+    def incr(self, name, value=1, tags=None):
+        pass
+
+
+class InMemorySink(MetricsSink):
+    """
+    Keeps counters, and the count, total and histogram of timings, in memory.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.timings = {}
+
+    def _key(self, name, tags):
+        return (name, tuple(sorted((tags or {}).items())))
+
+    def timing(self, name, seconds, tags=None):
+        key = self._key(name, tags)
+        with self._lock:
+            timing = self.timings.get(key)
+            if timing is None:
+                timing = self.timings[key] = {"count": 0, "sum": 0.0, "buckets": [0] * (len(BUCKETS) + 1)}
+            timing["count"] += 1
+            timing["sum"] += seconds
+            timing["buckets"][bisect_left(BUCKETS, seconds)] += 1
+
+    def incr(self, name, value=1, tags=None):
+        key = self._key(name, tags)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def get_counter(self, name, **tags):
+        return self.counters.get(self._key(name, tags), 0)
+
+    def get_timing(self, name, **tags):
+        """
+        Returns the count, sum and histogram of the timing, or None.
+        """
+        timing = self.timings.get(self._key(name, tags))
+        if timing is not None:
+            return dict(timing, buckets=list(timing["buckets"]))
+
+
+_sinks = {}
+_local = threading.local()
+
+
+def get_sink():
+    """
+    Returns the sink set by NOTIFICATIONS_METRICS_SINK, one per process, or None.
+    """
+    path = settings.NOTIFICATIONS_METRICS_SINK
+    if path is None:
+        return None
+    sink = _sinks.get(path)
+    if sink is None:
+        sink = _sinks.setdefault(path, load_path_attr(path)())
+    return sink
+
+
+@contextmanager
+def collect_stages():
+    """
+    Yields a dictionary which, once the block is over, maps each stage timed
+    inside it in this thread to the seconds spent in it.
+    """
+    stages = {}
+    collectors = getattr(_local, "collectors", None)
+    if collectors is None:
+        collectors = _local.collectors = []
+    collectors.append(stages)
+    try:
+        yield stages
+    finally:
+        collectors.remove(stages)
+
+
+@contextmanager
+def stage(name):
+    """
+    Times the block as the given stage. Time spent in a stage nested in it
+    only counts toward the nested stage. Stages are only timed inside
+    ``collect_stages``.
+    """
+    collectors = getattr(_local, "collectors", None)
+    if not collectors:
+        yield
+        return
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    # seconds spent in nested stages
+    frame = [0.0]
+    stack.append(frame)
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        stack.pop()
+        if stack:
+            stack[-1][0] += elapsed
+        own = elapsed - frame[0]
+        for stages in collectors:
+            stages[name] = stages.get(name, 0.0) + own
+        sink = get_sink()
+        if sink is not None:
+            sink.timing("stage.{0}".format(name), own)
+
+
+def record_delivery(backend, delivered=0, failed=0, seconds=None):
+    """
+    Counts messages a backend delivered or failed to deliver, and the time it
+    took, tagged with the backend label.
+    """
+    sink = get_sink()
+    if sink is None:
+        return
+    tags = {"backend": get_backend_label(backend)}
+    if delivered:
+        sink.incr("backend.delivered", delivered, tags)
+    if failed:
+        sink.incr("backend.failed", failed, tags)
+    if seconds is not None:
+        sink.timing("backend.latency", seconds, tags)
+
+
+@contextmanager
+def delivering(backend, count=1):
+    """
+    Times the block as the transport stage, handing ``count`` messages to the
+    backend, and records them as delivered or failed. Backends that set
+    ``records_metrics`` record their deliveries themselves.
+    """
+    start = time.time()
+    with stage("transport"):
+        try:
+            yield
+        except Exception:
+            if not getattr(backend, "records_metrics", False):
+                record_delivery(backend, failed=count, seconds=time.time() - start)
+            raise
+    if not getattr(backend, "records_metrics", False):
+        record_delivery(backend, delivered=count, seconds=time.time() - start)
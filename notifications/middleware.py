@@ -0,0 +1,14 @@
+from notifications.history import recorder
+
+
+class HistoryBufferMiddleware(object):
+    """
+    Buffers the notice history written while handling a request and writes it
+    in bulk once the response is ready.
+    """
+    def process_request(self, request):
+        recorder.start()
+
+    def process_response(self, request, response):
+        recorder.stop()
+        return response
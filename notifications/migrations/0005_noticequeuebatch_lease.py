@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0004_auto_20150708_1036'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='noticequeuebatch',
+            name='claimed_by',
+            field=models.CharField(max_length=255, blank=True, null=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='noticequeuebatch',
+            name='lease_until',
+            field=models.DateTimeField(blank=True, null=True, editable=False),
+        ),
+    ]
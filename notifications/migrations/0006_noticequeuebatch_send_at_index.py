@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0005_noticequeuebatch_lease'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='noticequeuebatch',
+            name='send_at',
+            field=models.DateTimeField(blank=True, null=True, db_index=True),
+        ),
+    ]
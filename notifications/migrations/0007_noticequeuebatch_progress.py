@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0006_noticequeuebatch_send_at_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='noticequeuebatch',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='noticequeuebatch',
+            name='failed_at',
+            field=models.DateTimeField(blank=True, null=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='noticequeuebatch',
+            name='last_error',
+            field=models.TextField(blank=True, null=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='noticequeuebatch',
+            name='position',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
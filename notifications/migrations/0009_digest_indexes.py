@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0008_noticequeuebatch_payload'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='noticehistory',
+            index_together=set([('notice_type', 'sent_at')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='noticethrough',
+            index_together=set([('user', 'history')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0009_digest_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='noticetype',
+            name='label',
+            field=models.CharField(verbose_name='label', max_length=40, db_index=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0010_noticetype_label_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='noticequeuebatch',
+            name='priority',
+            field=models.SmallIntegerField(default=0),
+        ),
+        migrations.AlterIndexTogether(
+            name='noticequeuebatch',
+            index_together=set([('priority', 'send_at')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0011_noticequeuebatch_priority'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='digestsubscription',
+            name='frequency',
+            field=models.PositiveIntegerField(default=10800, help_text='Frequency of digest notifications, in minutes'),
+        ),
+    ]
@@ -3,23 +3,31 @@ from __future__ import print_function
 
 import base64
 import json
+import uuid
+from collections import OrderedDict
 
-from django.db import models
+from django.db import models, transaction
+from django.core.cache import caches
 from django.core.exceptions import ImproperlyConfigured
-from django.core import serializers
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from django.utils.translation import get_language, activate
 from django.utils.encoding import python_2_unicode_compatible
-from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
 
 from six.moves import cPickle
 from notifications.utils import (
-    load_media_defaults, assemble_emails,
-    separate_emails_and_users,
+    load_media_defaults, assemble_recipients,
+    resolve_recipients, chunked,
 )
+from notifications.backends import open_backends
+from notifications.delivery import Dispatcher
+from notifications.metrics import collect_stages, stage, delivering
+from notifications.ratelimit import batch_size, throttle
+from notifications.signals import notice_sent
+from notifications.history import record_history
+from notifications.payload import encode_payload, decode_payload
 from notifications.conf import settings
 
 NOTICE_MEDIA, NOTICE_MEDIA_DEFAULTS = load_media_defaults()
@@ -29,17 +37,83 @@ class LanguageStoreNotAvailable(Exception):
     pass
 
 
+NOTICE_TYPE_VERSION_KEY = "notifications:notice_types:version"
+
+
+class NoticeTypeManager(models.Manager):
+    """
+    Keeps every NoticeType in memory, loaded with a single query the first time
+    one is looked up, so sending a notice doesn't query for its type.
+    """
+    # shared by all managers of the process, keyed by database alias
+    _cache = {}
+
+    def _shared_version(self):
+        if settings.NOTIFICATIONS_TYPE_CACHE is None:
+            return None
+        return caches[settings.NOTIFICATIONS_TYPE_CACHE].get(NOTICE_TYPE_VERSION_KEY)
+
+    def _get_registry(self, reload=False):
+        version = self._shared_version()
+        registry = self._cache.get(self.db)
+        if reload or registry is None or registry["version"] != version:
+            registry = {"version": version, "labels": {}, "ids": {}}
+            for notice_type in self.order_by("pk"):
+                # decode the assets up front
+                notice_type.get_assets()
+                registry["labels"].setdefault(notice_type.label, notice_type)
+                registry["ids"][notice_type.pk] = notice_type
+            self._cache[self.db] = registry
+        return registry
+
+    def _lookup(self, index, key):
+        registry = self._get_registry()
+        if key not in registry[index]:
+            # it may have been added since the types were loaded
+            registry = self._get_registry(reload=True)
+        try:
+            return registry[index][key]
+        except KeyError:
+            raise self.model.DoesNotExist("NoticeType matching {0} {1!r} does not exist.".format(index[:-1], key))
+
+    def get_for_label(self, label):
+        """
+        Returns the NoticeType with the given label, from the cache if possible.
+        """
+        return self._lookup("labels", label)
+
+    def get_for_id(self, id):
+        """
+        Returns the NoticeType with the given primary key, from the cache if
+        possible.
+        """
+        return self._lookup("ids", id)
+
+    def clear_cache(self):
+        """
+        Clears the cache of notice types in this process and, when
+        NOTIFICATIONS_TYPE_CACHE is set, in every other one.
+        """
+        self._cache.clear()
+        if settings.NOTIFICATIONS_TYPE_CACHE is not None:
+            caches[settings.NOTIFICATIONS_TYPE_CACHE].set(NOTICE_TYPE_VERSION_KEY, uuid.uuid4().hex, None)
+
+
+def clear_notice_type_cache(sender, **kwargs):
+    NoticeType.objects.clear_cache()
+
+
 @python_2_unicode_compatible
 class NoticeType(models.Model):
     """
     Defines types of notices, which are used to set presets for different templates and
     """
-    label = models.CharField(_("label"), max_length=40)
+    label = models.CharField(_("label"), max_length=40, db_index=True)
     display = models.CharField(_("display"), max_length=50)
     description = models.CharField(_("description"), max_length=100)
     assets = models.TextField(_("assets"), null=True, blank=True)
 
-    objects = models.Manager()
+    objects = NoticeTypeManager()
     # by default only on for media with sensitivity less than or equal to this number
     default = models.IntegerField(_("default"))
 
@@ -51,13 +125,19 @@ class NoticeType(models.Model):
         verbose_name_plural = _("Notice Types")
 
     def set_assets(self, asset_list):
-        self.extra_context = serializers.serialize("json", asset_list)
+        self.assets = json.dumps(asset_list)
 
     def get_assets(self):
-        if self.assets is not None:
-            return serializers.deserialize("json", self.assets)
-        else:
+        """
+        Returns the list of asset file names, decoding the JSON only once for
+        as long as it doesn't change.
+        """
+        if self.assets is None:
             return []
+        cached = getattr(self, "_assets_cache", None)
+        if cached is None or cached[0] != self.assets:
+            cached = self._assets_cache = (self.assets, json.loads(self.assets))
+        return list(cached[1])
 
     @classmethod
     def create(cls, label, display, description, assets=None, default=2):
@@ -107,17 +187,190 @@ class NoticeSetting(models.Model):
         unique_together = ("user", "notice_type", "medium", "scoping_content_type", "scoping_object_id")
 
 
+class NoticeQueueBatchQuerySet(models.QuerySet):
+
+    def due(self, now=None):
+        """
+        Batches whose send_at has passed or that have none, most urgent
+        priority first, then those without a send_at, then in send_at order.
+        """
+        if now is None:
+            now = timezone.now()
+        return self.filter(
+            models.Q(send_at__isnull=True) | models.Q(send_at__lte=now),
+            failed_at__isnull=True,
+        ).extra(
+            # batches without a send_at come first; databases disagree on where NULLs sort
+            select={"scheduled": "CASE WHEN send_at IS NULL THEN 0 ELSE 1 END"},
+            order_by=["priority", "scheduled", "send_at", "pk"],
+        )
+
+    def lanes(self, max_priority=None):
+        """
+        Batches with a priority of at most ``max_priority``, or all of them if
+        it is None.
+        """
+        if max_priority is None:
+            return self
+        return self.filter(priority__lte=max_priority)
+
+    def claimable(self, now=None):
+        """
+        Batches no worker holds a live lease on.
+        """
+        if now is None:
+            now = timezone.now()
+        return self.filter(models.Q(claimed_by__isnull=True) | models.Q(lease_until__lt=now))
+
+    def next_due(self, now=None):
+        """
+        Returns the earliest time after ``now`` at which a batch becomes due or
+        its lease runs out, or None if there is no such batch.
+        """
+        if now is None:
+            now = timezone.now()
+        pending = self.filter(failed_at__isnull=True)
+        times = [
+            pending.filter(send_at__gt=now).aggregate(next=models.Min("send_at"))["next"],
+            pending.filter(lease_until__gte=now).aggregate(next=models.Min("lease_until"))["next"],
+        ]
+        times = [value for value in times if value is not None]
+        return min(times) if times else None
+
+    def failed(self):
+        """
+        Batches that ran out of attempts (the dead-letter queue).
+        """
+        return self.filter(failed_at__isnull=False)
+
+    def requeue(self):
+        """
+        Gives failed batches a fresh set of attempts.
+        """
+        return self.update(failed_at=None, attempts=0, claimed_by=None, lease_until=None)
+
+
 class NoticeQueueBatch(models.Model):
     """
     A queued notice.
     Denormalized data for a notice.
     """
-    pickled_data = models.TextField()
-    send_at = models.DateTimeField(null=True, blank=True)
+    # notices queued by older releases, see get_notices
+    pickled_data = models.TextField(blank=True, default="")
+    payload = models.BinaryField(null=True, blank=True)
+    send_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    # lower numbers are emitted first
+    priority = models.SmallIntegerField(default=0)
+    claimed_by = models.CharField(max_length=255, null=True, blank=True, editable=False)
+    lease_until = models.DateTimeField(null=True, blank=True, editable=False)
+    # number of notices at the start of the batch that have been emitted
+    position = models.PositiveIntegerField(default=0, editable=False)
+    attempts = models.PositiveSmallIntegerField(default=0, editable=False)
+    last_error = models.TextField(null=True, blank=True, editable=False)
+    failed_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    objects = NoticeQueueBatchQuerySet.as_manager()
 
     class Meta:
         verbose_name = _("Notice Queue Batch")
         verbose_name_plural = _("Notice Queue Batches")
+        index_together = [("priority", "send_at")]
+
+    def set_payload(self, recipients, label, extra_context, sender, attachments):
+        self.payload = encode_payload(recipients, label, extra_context, sender, attachments)
+
+    def get_notices(self):
+        """
+        Returns the queued notices as a list of
+        ``(recipient, label, extra_context, sender, attachments)`` tuples.
+        """
+        if self.payload is None:
+            return cPickle.loads(base64.b64decode(self.pickled_data))
+        data = decode_payload(self.payload)
+        return [
+            (recipient, data["label"], data["extra_context"], data["sender"], data["attachments"])
+            for recipient in data["recipients"]
+        ]
+
+    def claim(self, worker_id):
+        """
+        Claims the batch for the worker for NOTIFICATIONS_LEASE_SECONDS, unless
+        it isn't due anymore, has failed for good or another worker holds a
+        lease on it that has not expired. The claim is a single conditional UPDATE, so only one worker
+        can win it. Once claimed, the progress of the batch is reloaded, as the
+        instance may predate another worker's attempt at it.
+        """
+        now = timezone.now()
+        lease_until = now + timezone.timedelta(seconds=settings.NOTIFICATIONS_LEASE_SECONDS)
+        claimed = NoticeQueueBatch.objects.filter(
+            models.Q(claimed_by__isnull=True) | models.Q(lease_until__lt=now) | models.Q(claimed_by=worker_id),
+            models.Q(send_at__isnull=True) | models.Q(send_at__lte=now),
+            pk=self.pk, failed_at__isnull=True,
+        ).update(claimed_by=worker_id, lease_until=lease_until)
+        if claimed:
+            self.claimed_by, self.lease_until = worker_id, lease_until
+            self.position, self.attempts, self.send_at, self.failed_at = NoticeQueueBatch.objects.filter(
+                pk=self.pk
+            ).values_list("position", "attempts", "send_at", "failed_at").get()
+        return bool(claimed)
+
+    def renew_lease(self):
+        """
+        Extends the lease of the worker holding the batch. Returns False if the
+        lease was lost to another worker in the meantime.
+        """
+        return self._update_claimed()
+
+    def checkpoint(self, position):
+        """
+        Records that the first ``position`` notices have been emitted and
+        renews the lease. Returns False if the lease was lost.
+        """
+        if self._update_claimed(position=position):
+            self.position = position
+            return True
+        return False
+
+    def release(self):
+        """
+        Gives up the claim so that any worker can pick the batch up again.
+        """
+        NoticeQueueBatch.objects.filter(
+            pk=self.pk, claimed_by=self.claimed_by
+        ).update(claimed_by=None, lease_until=None)
+        self.claimed_by, self.lease_until = None, None
+
+    def fail(self, error):
+        """
+        Records a failed attempt and releases the batch so it is retried from
+        its last checkpoint, NOTIFICATIONS_QUEUE_RETRY_DELAY seconds later, a
+        delay that doubles with each attempt. After
+        NOTIFICATIONS_QUEUE_MAX_ATTEMPTS attempts the batch is marked as failed
+        instead and left alone. Returns whether it was.
+        """
+        now = timezone.now()
+        self.attempts += 1
+        self.last_error = error
+        if self.attempts >= settings.NOTIFICATIONS_QUEUE_MAX_ATTEMPTS:
+            self.failed_at = now
+        else:
+            delay = settings.NOTIFICATIONS_QUEUE_RETRY_DELAY * 2 ** (self.attempts - 1)
+            self.send_at = max(self.send_at or now, now + timezone.timedelta(seconds=delay))
+        NoticeQueueBatch.objects.filter(pk=self.pk, claimed_by=self.claimed_by).update(
+            attempts=self.attempts, last_error=self.last_error, failed_at=self.failed_at,
+            send_at=self.send_at, claimed_by=None, lease_until=None
+        )
+        self.claimed_by, self.lease_until = None, None
+        return self.failed_at is not None
+
+    def _update_claimed(self, **fields):
+        lease_until = timezone.now() + timezone.timedelta(seconds=settings.NOTIFICATIONS_LEASE_SECONDS)
+        updated = NoticeQueueBatch.objects.filter(
+            pk=self.pk, claimed_by=self.claimed_by
+        ).update(lease_until=lease_until, **fields)
+        if updated:
+            self.lease_until = lease_until
+        return bool(updated)
 
 
 class NoticeHistory(models.Model):
@@ -134,9 +387,10 @@ class NoticeHistory(models.Model):
     class Meta:
         verbose_name = _("Notice History")
         verbose_name_plural = _("Notice History")
+        index_together = [("notice_type", "sent_at")]
 
     def save(self, *args, **kwargs):
-        if not self.id:
+        if not self.id and self.sent_at is None:
             self.sent_at = timezone.now()
         return super(NoticeHistory, self).save(*args, **kwargs)
 
@@ -192,6 +446,9 @@ class NoticeThrough(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL)
     history = models.ForeignKey(NoticeHistory)
 
+    class Meta:
+        index_together = [("user", "history")]
+
 
 def get_notification_language(user):
     """
@@ -199,15 +456,33 @@ def get_notification_language(user):
     LanguageStoreNotAvailable if this site does not use translated
     notifications.
     """
-    if settings.NOTIFICATIONS_LANGUAGE_MODEL:
+    language = get_notification_languages([user]).get(user.pk)
+    if language is None:
+        raise LanguageStoreNotAvailable
+    return language
+
+
+def get_notification_languages(users):
+    """
+    Returns a dictionary mapping the primary keys of the given users to their
+    notification language, fetched with one query per
+    NOTIFICATIONS_RECIPIENT_CHUNK_SIZE users. Users without a language are
+    left out. Raises LanguageStoreNotAvailable if this site does not use
+    translated notifications.
+    """
+    if not settings.NOTIFICATIONS_LANGUAGE_MODEL:
+        raise LanguageStoreNotAvailable
+    try:
         model = settings.NOTIFICATIONS_GET_LANGUAGE_MODEL()
-        try:
-            language = model.objects.get(user__id__exact=user.id)
+    except (ImportError, ImproperlyConfigured):
+        raise LanguageStoreNotAvailable
+    languages = {}
+    user_ids = [user.pk for user in users]
+    for chunk in chunked(user_ids, settings.NOTIFICATIONS_RECIPIENT_CHUNK_SIZE):
+        for language in model.objects.filter(user__in=chunk):
             if hasattr(language, "language"):
-                return language.language
-        except (ImportError, ImproperlyConfigured, model.DoesNotExist):
-            raise LanguageStoreNotAvailable
-    raise LanguageStoreNotAvailable
+                languages[language.user_id] = language.language
+    return languages
 
 
 def send(*args, **kwargs):
@@ -236,7 +511,26 @@ def send_now(users, label, extra_context=None, sender=None, scoping=None, attach
     Creates a new notice.
     This is intended to be how other apps create new notices.
     """
-    sent = False
+    return bool(deliver_notice(users, label, extra_context, sender, scoping, attachments))
+
+
+def deliver_notice(users, label, extra_context=None, sender=None, scoping=None, attachments=None,
+                   dispatcher=None):
+    """
+    Sends one notice to all the given users and email addresses and records it
+    in a single NoticeHistory. Returns the list of users it was delivered to,
+    after sending the ``notice_sent`` signal with the time spent in each stage.
+
+    A ``dispatcher`` (see ``notifications.delivery.Dispatcher``) takes over
+    sending the rendered messages.
+    """
+    with collect_stages() as stages:
+        sent_users = _deliver_notice(users, label, extra_context, sender, scoping, attachments, dispatcher)
+    notice_sent.send(sender=NoticeType, label=label, sent_users=sent_users, stages=stages)
+    return sent_users
+
+
+def _deliver_notice(users, label, extra_context, sender, scoping, attachments, dispatcher):
     if sender is None:
         sender = settings.DEFAULT_FROM_EMAIL
     if extra_context is None:
@@ -244,68 +538,117 @@ def send_now(users, label, extra_context=None, sender=None, scoping=None, attach
     if attachments is None:
         attachments = []
 
-    email_list, user_list = separate_emails_and_users(users)
-    usermodel = get_user_model()
-    for email in email_list:
-        try:
-            user = usermodel.objects.get(email=email)
-            user_list.append(user)
-            email_list.remove(email)
-        except usermodel.DoesNotExist:
-            pass
+    with stage("resolve"):
+        user_list, email_list = resolve_recipients(users)
 
-    notice_type = NoticeType.objects.get(label=label)
+    notice_type = NoticeType.objects.get_for_label(label)
     current_language = get_language()
 
-    sent_users = []
-    for user in user_list:
-        # get user language for user from language store defined in
-        # NOTIFICATION_LANGUAGE_MODULE setting
-        try:
-            language = get_notification_language(user)
-            activate(language)
-        except LanguageStoreNotAvailable:
-            pass
-
-        additional_context = extra_context
-        additional_context["user"] = user
-        for backend in settings.NOTIFICATIONS_BACKENDS.values():
-            if backend.can_send(user, notice_type, scoping=scoping):
-                backend.deliver(notice_type, additional_context, attachments, user.email, sender)
-                sent = True
-                sent_users.append(user)
-
-        # reset environment to original language
-        activate(current_language)
-
-    for email in email_list:
-        backend = settings.NOTIFICATIONS_DEFAULT_BACKEND
-        backend.deliver(notice_type, extra_context, attachments, email, sender)
-
-    history = NoticeHistory(notice_type=notice_type, sender=sender,
-                            extra_context=base64.b64encode(cPickle.dumps(extra_context)),
-                            attachments=json.dumps(attachments))
-    history.save()
-    throughlist = []
-    for user_email in sent_users:
-        throughlist.append(NoticeThrough(user=user_email, history=history))
-    NoticeThrough.objects.bulk_create(throughlist)
+    # context shared by all recipients, built once per backend and language
+    shared_contexts = {}
 
-    return sent
+    def get_shared_context(backend):
+        key = (id(backend), get_language())
+        if key not in shared_contexts:
+            with stage("render"):
+                shared_contexts[key] = backend.get_shared_context(notice_type, extra_context, sender)
+        return shared_contexts[key]
 
+    # the users each backend may deliver to, looked up in bulk
+    allowed = []
+    with stage("preferences"):
+        for backend in settings.NOTIFICATIONS_BACKENDS.values():
+            user_ids = set(user.pk for user in backend.filter_can_send(user_list, notice_type, scoping))
+            allowed.append((backend, user_ids))
+
+    # group users by the language store defined in the
+    # NOTIFICATIONS_LANGUAGE_MODEL setting so each language is activated once
+    try:
+        with stage("resolve"):
+            languages = get_notification_languages(user_list)
+    except LanguageStoreNotAvailable:
+        languages = {}
+    language_groups = OrderedDict()
+    for user in user_list:
+        language_groups.setdefault(languages.get(user.pk), []).append(user)
+
+    # with NOTIFICATIONS_DELIVERY_WORKERS messages are rendered here and sent from a thread pool
+    if dispatcher is None and settings.NOTIFICATIONS_DELIVERY_WORKERS:
+        dispatcher = Dispatcher()
+
+    def deliver(backend, recipients):
+        # recipients are (user pk or None, extra_context, email) tuples
+        if not recipients:
+            return
+        if getattr(backend, "accepts_shared_context", False):
+            shared_context = get_shared_context(backend)
+        else:
+            # backends that don't take a shared context get the whole context of each recipient
+            shared_context = None
+            recipients = [(recipient, dict(extra_context, **context), email)
+                          for recipient, context, email in recipients]
+        if dispatcher is None:
+            for chunk in chunked(recipients, batch_size(backend, settings.NOTIFICATIONS_DELIVERY_CHUNK_SIZE)):
+                throttle(backend, len(chunk))
+                with delivering(backend, len(chunk)):
+                    backend.deliver_bulk(notice_type, shared_context,
+                                         [(email, context) for _, context, email in chunk], attachments, sender)
+        else:
+            for recipient, context, email in recipients:
+                with stage("render"):
+                    message = backend.build_message(notice_type, context, attachments, email, sender,
+                                                    shared_context=shared_context)
+                dispatcher.add(backend, recipient, message)
 
-def queue(users, label, extra_context=None, sender=None, send_at=None, attachments=None):
+    sent_users = []
+    errors = []
+    with open_backends():
+        try:
+            for language, users_group in language_groups.items():
+                if language is not None:
+                    activate(language)
+                try:
+                    for backend, user_ids in allowed:
+                        deliver(backend, [(user.pk, {"user": user}, user.email)
+                                          for user in users_group if user.pk in user_ids])
+                    sent_users.extend(
+                        user for user in users_group if any(user.pk in user_ids for _, user_ids in allowed)
+                    )
+                finally:
+                    # reset environment to original language
+                    activate(current_language)
+
+            deliver(settings.NOTIFICATIONS_DEFAULT_BACKEND, [(None, {}, email) for email in email_list])
+        finally:
+            if dispatcher is not None:
+                # only the users a message was actually sent to count as sent
+                with stage("transport"):
+                    sent, errors = dispatcher.wait()
+                sent_users = [user for user in sent_users if user.pk in sent]
+
+    record_history(notice_type, sender, extra_context, attachments, sent_users)
+
+    if errors:
+        raise errors[0]
+
+    return sent_users
+
+
+def queue(users, label, extra_context=None, sender=None, send_at=None, attachments=None, priority=0):
     """
     Queue the notification in NoticeQueueBatch. This allows for large amounts
     of user notifications to be deferred to a seperate process running outside
-    the webserver.
+    the webserver. Recipients are written in batches of at most
+    NOTIFICATIONS_QUEUE_BATCH_SIZE, and QuerySets are streamed, so queueing a
+    notice to a large number of users never holds them all in memory.
+    Batches with a lower ``priority`` are emitted first.
     """
     if extra_context is None:
         extra_context = {}
     if attachments is None:
-        attachments = {}
-    user_list = assemble_emails(users)
-    notices = []
-    for user in user_list:
-        notices.append((user, label, extra_context, sender, attachments))
-    NoticeQueueBatch(pickled_data=base64.b64encode(cPickle.dumps(notices)), send_at=send_at).save()
+        attachments = []
+    with transaction.atomic():
+        for recipients in chunked(assemble_recipients(users), settings.NOTIFICATIONS_QUEUE_BATCH_SIZE):
+            batch = NoticeQueueBatch(send_at=send_at, priority=priority)
+            batch.set_payload(recipients, label, extra_context, sender, attachments)
+            batch.save()
@@ -0,0 +1,49 @@
+"""
+Encoding of the notices stored in a NoticeQueueBatch.
+
+A payload is a version byte followed by zlib compressed data. The data holds
+the fields shared by every notice of the batch once, next to the list of
+recipients. Version 1 stores the data as JSON. Version 2 pickles it and is
+only used for extra context that does not survive a round trip through JSON
+unchanged, such as model instances or dates.
+"""
+import json
+import zlib
+
+from six.moves import cPickle as pickle
+
+
+PAYLOAD_JSON = 1
+PAYLOAD_PICKLE = 2
+
+
+def encode_payload(recipients, label, extra_context, sender, attachments):
+    data = {
+        "recipients": list(recipients),
+        "label": label,
+        "extra_context": extra_context,
+        "sender": sender,
+        "attachments": attachments,
+    }
+    try:
+        raw = json.dumps(data, separators=(",", ":"))
+        if json.loads(raw) != data:
+            raise ValueError("payload changes when encoded as JSON")
+        version, raw = PAYLOAD_JSON, raw.encode("utf-8")
+    except (TypeError, ValueError):
+        version, raw = PAYLOAD_PICKLE, pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+    return bytes(bytearray([version])) + zlib.compress(raw)
+
+
+def decode_payload(payload):
+    """
+    Returns the dictionary encoded by ``encode_payload``.
+    """
+    payload = bytes(payload)
+    version = bytearray(payload[:1])[0]
+    raw = zlib.decompress(payload[1:])
+    if version == PAYLOAD_JSON:
+        return json.loads(raw.decode("utf-8"))
+    elif version == PAYLOAD_PICKLE:
+        return pickle.loads(raw)
+    raise ValueError("unknown notice payload version {0}".format(version))
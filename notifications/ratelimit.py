@@ -0,0 +1,162 @@
+import math
+import time
+import threading
+
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+
+from notifications.backends import get_backend_label
+from notifications.conf import settings
+from notifications.metrics import get_sink, stage
+
+
+# the clock token buckets are refilled by, unaffected by changes to the system time
+clock = getattr(time, "monotonic", time.time)
+
+
+class TokenBucket(object):
+    """
+    Lets ``rate`` messages a second through on average, and up to ``burst``
+    at once. Shared by the threads of a process.
+
+    Tokens are reserved rather than waited for: ``reserve`` takes them at once,
+    running the bucket into debt if need be, and returns how long the caller
+    must wait before sending, so waiting callers are let through in turn.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(1, int(rate))
+        self.tokens = float(self.burst)
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        with self._lock:
+            now = clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= tokens
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+class CacheTokenBucket(object):
+    """
+    A ``TokenBucket`` shared by every process using the same cache, following
+    the generic cell rate algorithm. Time is cut into emission slots of
+    ``1 / rate`` seconds, and each message claims a slot of its own with the
+    cache's atomic ``add``; slot ``k`` may be used ``burst`` slots ahead of its
+    time. So over any period of ``t`` seconds at most ``rate * t + burst``
+    messages go out, however many processes share the bucket.
+    """
+    # the furthest ahead a slot is looked for, in seconds
+    horizon = 3600
+
+    def __init__(self, rate, burst=None, cache=None, key="notifications:ratelimit"):
+        self.rate = float(rate)
+        self.burst = burst or max(1, int(rate))
+        self.interval = 1 / self.rate
+        self.cache = caches[cache or "default"]
+        self.key = key
+        probe = "{0}:probe".format(key)
+        self.cache.set(probe, 1, 60)
+        if self.cache.get(probe) != 1:
+            raise ImproperlyConfigured(
+                "NOTIFICATIONS_RATE_LIMIT_CACHE must be a cache that keeps what is stored in it."
+            )
+
+    def reserve(self, tokens=1):
+        # the slots are shared between hosts, so they follow the wall clock
+        now = time.time()
+        first = int(now / self.interval)
+        # a hint of the first free slot, so waiting callers don't scan the slots taken before them
+        slot = max(first, self.cache.get("{0}:next".format(self.key)) or 0)
+        last = first + int(self.horizon * self.rate) + self.burst
+        for _ in range(tokens):
+            while not self.cache.add("{0}:{1}".format(self.key, slot), 1,
+                                     int(math.ceil(slot * self.interval - now)) + 2):
+                slot += 1
+                if slot > last:
+                    raise ImproperlyConfigured(
+                        "NOTIFICATIONS_RATE_LIMIT_CACHE found no free slot for {0}; its cache "
+                        "may not support an atomic add.".format(self.key)
+                    )
+            slot += 1
+        self.cache.set("{0}:next".format(self.key), slot, int(math.ceil(slot * self.interval - now)) + 2)
+        # slot - 1 is the last slot taken
+        return max(0.0, (slot - self.burst) * self.interval - now)
+
+
+_buckets = {}
+_lock = threading.Lock()
+
+
+def get_bucket(backend):
+    """
+    Returns the token bucket NOTIFICATIONS_RATE_LIMITS sets for the backend's
+    label, or None if it isn't limited. The bucket is kept in the cache set by
+    NOTIFICATIONS_RATE_LIMIT_CACHE, if any, to be shared between processes.
+    """
+    label = get_backend_label(backend)
+    limit = settings.NOTIFICATIONS_RATE_LIMITS.get(label)
+    if not limit:
+        return None
+    rate, burst = limit if isinstance(limit, (list, tuple)) else (limit, None)
+    cache = settings.NOTIFICATIONS_RATE_LIMIT_CACHE
+    key = (label, rate, burst, cache)
+    with _lock:
+        if key not in _buckets:
+            if cache is None:
+                _buckets[key] = TokenBucket(rate, burst)
+            else:
+                _buckets[key] = CacheTokenBucket(
+                    rate, burst, cache, "notifications:ratelimit:{0}".format(label)
+                )
+        return _buckets[key]
+
+
+def batch_size(backend, size):
+    """
+    Caps the number of messages handed to the backend at once to the burst of
+    its rate limit.
+    """
+    bucket = get_bucket(backend)
+    if bucket is None:
+        return size
+    return min(size, bucket.burst)
+
+
+def reserve(backend, count=1):
+    """
+    Reserves ``count`` messages of the backend's rate limit. Returns the
+    seconds to wait before sending them.
+    """
+    bucket = get_bucket(backend)
+    if bucket is None:
+        return 0.0
+    delay = bucket.reserve(count)
+    if delay:
+        sink = get_sink()
+        if sink is not None:
+            sink.timing("backend.throttled", delay, {"backend": get_backend_label(backend)})
+    return delay
+
+
+def wait(backend, count=1):
+    """
+    Blocks until the backend's rate limit lets ``count`` messages through.
+    """
+    delay = reserve(backend, count)
+    if delay:
+        with stage("throttle"):
+            time.sleep(delay)
+
+
+def throttle(backend, count=1):
+    """
+    Like ``wait``, except for backends that set ``throttles`` and pace their
+    transport themselves.
+    """
+    if not getattr(backend, "throttles", False):
+        wait(backend, count)
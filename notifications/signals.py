@@ -2,5 +2,13 @@ import django.dispatch
 
 
 emitted_notices = django.dispatch.Signal(
-    providing_args=["batches", "sent", "sent_actual", "run_time"]
+    providing_args=["batches", "sent", "sent_actual", "delivered", "run_time", "stages"]
+)
+
+notice_sent = django.dispatch.Signal(
+    providing_args=["label", "sent_users", "stages"]
+)
+
+digests_sent = django.dispatch.Signal(
+    providing_args=["digests", "stages"]
 )
@@ -3,9 +3,13 @@ from django.contrib.auth import get_user_model
 from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.contenttypes.models import ContentType
 
+from notifications.cache import get_cache
 from notifications.conf import settings
 from notifications.compat import basestring
 
+# values stored in the notice setting cache
+SETTING_SEND, SETTING_DONT_SEND, SETTING_DEFAULT = 1, 0, -1
+
 
 def load_media_defaults():
     media = []
@@ -52,17 +56,104 @@ def notice_setting_for_user(user, notice_type, medium, scoping=None):
         return setting
 
 
-def assemble_emails(user_list):
-    email_list = []
+def get_notice_setting_cache():
+    return get_cache("notice_settings", settings.NOTIFICATIONS_SETTINGS_CACHE,
+                     settings.NOTIFICATIONS_SETTINGS_CACHE_SIZE)
+
+
+def notice_setting_cache_key(user_id, notice_type_id, medium, scoping_content_type_id, scoping_object_id):
+    return "notifications:setting:{0}:{1}:{2}:{3}:{4}".format(
+        user_id, notice_type_id, medium,
+        scoping_content_type_id or "", scoping_object_id or ""
+    )
+
+
+def clear_notice_setting_cache(sender, instance, **kwargs):
+    """
+    Drops a NoticeSetting from the cache when it is saved or deleted.
+    """
+    cache = get_notice_setting_cache()
+    if cache is not None:
+        cache.delete(notice_setting_cache_key(
+            instance.user_id, instance.notice_type_id, instance.medium,
+            instance.scoping_content_type_id, instance.scoping_object_id
+        ))
+
+
+def notice_settings_for_users(users, notice_type, medium, scoping=None):
+    """
+    Returns a dictionary mapping the primary key of each user to whether they
+    may receive the notice type on the medium with the given scoping. Stored
+    settings are fetched with one query per NOTIFICATIONS_RECIPIENT_CHUNK_SIZE
+    users; users without one get the medium default, which is not saved.
+    """
+    from notifications.models import NoticeSetting
+
+    kwargs = {
+        "notice_type": notice_type,
+        "medium": medium
+    }
+    if scoping:
+        scoping_content_type_id = ContentType.objects.get_for_model(scoping).pk
+        scoping_object_id = scoping.pk
+        kwargs.update({
+            "scoping_content_type_id": scoping_content_type_id,
+            "scoping_object_id": scoping_object_id
+        })
+    else:
+        scoping_content_type_id = scoping_object_id = None
+        kwargs.update({
+            "scoping_content_type__isnull": True,
+            "scoping_object_id__isnull": True
+        })
+
+    keys = dict(
+        (user.pk, notice_setting_cache_key(user.pk, notice_type.pk, medium,
+                                           scoping_content_type_id, scoping_object_id))
+        for user in users
+    )
+    cache = get_notice_setting_cache()
+    cached = cache.get_many(list(keys.values())) if cache is not None else {}
+
+    stored = {}
+    missing = [user_id for user_id, key in keys.items() if key not in cached]
+    for chunk in chunked(missing, settings.NOTIFICATIONS_RECIPIENT_CHUNK_SIZE):
+        found = dict(NoticeSetting.objects.filter(user__in=chunk, **kwargs).values_list("user_id", "send"))
+        for user_id in chunk:
+            if user_id not in found:
+                stored[keys[user_id]] = SETTING_DEFAULT
+            elif found[user_id]:
+                stored[keys[user_id]] = SETTING_SEND
+            else:
+                stored[keys[user_id]] = SETTING_DONT_SEND
+    if cache is not None and stored:
+        cache.set_many(stored, settings.NOTIFICATIONS_SETTINGS_CACHE_TIMEOUT)
+    cached.update(stored)
+
+    _, media_defaults = load_media_defaults()
+    default = media_defaults[medium] <= notice_type.default
+    result = {}
+    for user_id, key in keys.items():
+        value = cached[key]
+        result[user_id] = default if value == SETTING_DEFAULT else value == SETTING_SEND
+    return result
+
+
+def assemble_recipients(user_list):
+    """
+    Yields the identifier queued for each recipient: the primary key of users
+    and the address itself for email strings. QuerySets are streamed from the
+    database rather than loaded whole.
+    """
     if isinstance(user_list, models.QuerySet):
-        email_list = [row["pk"] for row in user_list.values("pk")]
+        for pk in user_list.order_by().values_list("pk", flat=True).iterator():
+            yield pk
     else:
         for user in user_list:
             if isinstance(user, get_user_model()):
-                email_list.append(user.email)
+                yield user.pk
             elif isinstance(user, basestring):
-                email_list.append(user)
-    return email_list
+                yield user
 
 
 def separate_emails_and_users(value_list):
@@ -74,3 +165,91 @@ def separate_emails_and_users(value_list):
         elif isinstance(value, basestring):
             email_list.append(value)
     return email_list, user_list
+
+
+def chunked(iterable, size):
+    """
+    Yields lists of at most ``size`` items from ``iterable``.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def get_users_by_email(emails, chunk_size=None):
+    """
+    Returns a dictionary mapping each of the given email addresses to its user,
+    issuing one ``email__in`` query per ``chunk_size`` addresses. Addresses
+    without a user are left out. If several users share an address the one
+    with the lowest primary key wins.
+    """
+    if chunk_size is None:
+        chunk_size = settings.NOTIFICATIONS_RECIPIENT_CHUNK_SIZE
+    usermodel = get_user_model()
+    users = {}
+    for chunk in chunked(set(emails), chunk_size):
+        for user in usermodel.objects.filter(email__in=chunk).order_by("pk"):
+            users.setdefault(user.email, user)
+    return users
+
+
+def get_users_by_pk(pks, chunk_size=None):
+    """
+    Returns a dictionary mapping each of the given primary keys to its user,
+    issuing one ``pk__in`` query per ``chunk_size`` keys.
+    """
+    if chunk_size is None:
+        chunk_size = settings.NOTIFICATIONS_RECIPIENT_CHUNK_SIZE
+    usermodel = get_user_model()
+    users = {}
+    for chunk in chunked(set(pks), chunk_size):
+        users.update((user.pk, user) for user in usermodel.objects.filter(pk__in=chunk))
+    return users
+
+
+def get_users_for_recipients(recipients, chunk_size=None):
+    """
+    Returns a dictionary mapping queued recipient identifiers, primary keys or
+    email addresses, to their users.
+    """
+    pks, emails = [], []
+    for recipient in recipients:
+        if isinstance(recipient, basestring):
+            emails.append(recipient)
+        else:
+            pks.append(recipient)
+    users = get_users_by_pk(pks, chunk_size)
+    users.update(get_users_by_email(emails, chunk_size))
+    return users
+
+
+def resolve_recipients(value_list, chunk_size=None):
+    """
+    Splits a mixed iterable of users and email addresses into a list of users
+    and a list of the addresses that do not belong to any user. Addresses are
+    resolved in bulk with ``get_users_by_email`` and duplicates are dropped.
+    """
+    email_list, user_list = separate_emails_and_users(value_list)
+    users_by_email = get_users_by_email(email_list, chunk_size)
+
+    users, emails = [], []
+    seen_users, seen_emails = set(), set()
+    for user in user_list:
+        if user.pk not in seen_users:
+            seen_users.add(user.pk)
+            users.append(user)
+    for email in email_list:
+        user = users_by_email.get(email)
+        if user is not None:
+            if user.pk not in seen_users:
+                seen_users.add(user.pk)
+                users.append(user)
+        elif email not in seen_emails:
+            seen_emails.add(email)
+            emails.append(email)
+    return users, emails
@@ -1,7 +1,15 @@
+import sys
 import codecs
 from os import path
 
 from setuptools import find_packages, setup
+from setuptools.command.build_py import build_py
+
+
+# modules using syntax older interpreters can't compile, by the Python version they need
+VERSIONED_MODULES = {
+    ("notifications", "aio"): (3, 5),
+}
 
 
 def read(*parts):
@@ -10,6 +18,19 @@ def read(*parts):
         return fp.read()
 
 
+class BuildPy(build_py):
+    """
+    Leaves out the modules the running Python can't compile, so installing on
+    it doesn't fail to byte-compile them.
+    """
+    def find_package_modules(self, package, package_dir):
+        modules = build_py.find_package_modules(self, package, package_dir)
+        return [
+            module for module in modules
+            if sys.version_info >= VERSIONED_MODULES.get(module[:2], (0,))
+        ]
+
+
 setup(
     author="Aaron Cunningham",
     author_email="aa.cunningham@outlook.com",
@@ -18,7 +39,7 @@ setup(
     long_description=read("README.md"),
     version="0.2.0",
     license="MIT",
-    packages=find_packages(exclude=["tests"]),
+    packages=find_packages(exclude=["tests", "benchmarks"]),
     include_package_data=True,
     package_data={
         "notifications": [
@@ -28,11 +49,11 @@ setup(
     install_requires=[
         "django-appconf>=1.0.1",
         "django>=1.7",
-        "lockfile==0.10.2",
         "celery",
         "django-celery",
     ],
     test_suite="runtests.runtests",
+    cmdclass={"build_py": BuildPy},
     classifiers=[
         "Development Status :: 5 - Production/Stable",
         "Environment :: Web Environment",
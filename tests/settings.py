@@ -1,3 +1,5 @@
+import os
+
 ROOT_URLCONF = 'notifications.urls'
 
 DATABASES = {
@@ -11,6 +13,8 @@ EMAIL_BACKEND = 'django.core.email.backends.locmem.EmailBackend'
 
 SECRET_KEY = 'fake-key'
 
+TEMPLATE_DIRS = [os.path.join(os.path.dirname(__file__), 'templates')]
+
 INSTALLED_APPS=[
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -0,0 +1,47 @@
+import sys
+import unittest
+
+from django.core import mail
+from django.test import TransactionTestCase
+from django.test.utils import override_settings
+from django.contrib.auth import get_user_model
+
+from notifications.models import NoticeType, NoticeHistory, NoticeQueueBatch
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    from notifications.aio import asend_now, aqueue
+
+
+@unittest.skipUnless(sys.version_info >= (3, 5), "asyncio support needs Python 3.5")
+# one database thread, as the in-memory SQLite test database locks out concurrent writers
+@override_settings(SITE_ID=1, NOTIFICATIONS_DELIVERY_CHUNK_SIZE=2, NOTIFICATIONS_ASYNC_WORKERS=1)
+class TestAsync(TransactionTestCase):
+    def setUp(self):
+        self.users = [
+            get_user_model().objects.create_user("user{0}".format(i), "user{0}@test.com".format(i), "123456")
+            for i in range(3)
+        ]
+        NoticeType.create("label", "display", "description")
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        mail.outbox = []
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def test_asend_now(self):
+        sent = self.loop.run_until_complete(asend_now(self.users + ["one@test.com"], "label"))
+        self.assertTrue(sent)
+        self.assertEqual(len(mail.outbox), 4)
+        self.assertEqual(NoticeHistory.objects.get().recipient.count(), 3)
+
+    def test_concurrent_calls(self):
+        calls = [asend_now([user], "label") for user in self.users]
+        self.assertEqual(self.loop.run_until_complete(asyncio.gather(*calls)), [True] * 3)
+        self.assertEqual(len(mail.outbox), 3)
+
+    def test_aqueue(self):
+        self.loop.run_until_complete(aqueue(self.users, "label"))
+        self.assertEqual(NoticeQueueBatch.objects.count(), 1)
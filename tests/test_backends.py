@@ -0,0 +1,300 @@
+import os
+import smtplib
+import unittest
+
+from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend as LocmemEmailBackend
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.contrib.auth import get_user_model
+
+from notifications.backends import open_backends
+from notifications.backends.base import BaseBackend
+from notifications.backends.email_backend import EmailBackend
+from notifications.cache import get_cache
+from notifications.conf import settings, is_installed
+from notifications.metrics import get_sink
+from notifications.models import NoticeType, NoticeHistory, send_now, deliver_notice
+
+
+class CountingEmailBackend(LocmemEmailBackend):
+    opened = 0
+    failures = 0
+    # messages sent before the connection drops
+    drop_after = 0
+    refused = set()
+
+    def open(self):
+        CountingEmailBackend.opened += 1
+
+    def send_messages(self, messages):
+        if CountingEmailBackend.failures:
+            if CountingEmailBackend.drop_after:
+                CountingEmailBackend.drop_after -= 1
+            else:
+                CountingEmailBackend.failures -= 1
+                raise smtplib.SMTPServerDisconnected()
+        for message in messages:
+            refused = set(message.recipients()) & CountingEmailBackend.refused
+            if refused:
+                raise smtplib.SMTPRecipientsRefused(dict((email, (550, b"unknown user")) for email in refused))
+        return super(CountingEmailBackend, self).send_messages(messages)
+
+
+@override_settings(SITE_ID=1, EMAIL_BACKEND="tests.test_backends.CountingEmailBackend")
+class TestEmailBackend(TestCase):
+    def setUp(self):
+        self.users = [
+            get_user_model().objects.create_user("user{0}".format(i), "user{0}@test.com".format(i), "123456")
+            for i in range(5)
+        ]
+        NoticeType.create("label", "display", "description")
+        CountingEmailBackend.opened = 0
+        CountingEmailBackend.failures = 0
+        CountingEmailBackend.drop_after = 0
+        CountingEmailBackend.refused = set()
+        mail.outbox = []
+        get_sink().reset()
+
+    @override_settings(NOTIFICATIONS_EMAIL_BATCH_SIZE=2)
+    def test_connection_reused(self):
+        send_now(self.users, "label")
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(CountingEmailBackend.opened, 1)
+        self.assertEqual(get_sink().get_timing("backend.latency", backend="email")["count"], 3)
+
+    def test_nested_runs(self):
+        backend = settings.NOTIFICATIONS_DEFAULT_BACKEND
+        with open_backends() as backends:
+            send_now(self.users[:2], "label")
+            send_now(self.users[2:], "label")
+            self.assertEqual(len(mail.outbox), 0)
+            # buffered messages count as sent
+            email_backend = settings.NOTIFICATIONS_BACKENDS[(0, "email")]
+            self.assertEqual(email_backend.send_messages([mail.EmailMessage("subject", "body", to=["two@test.com"])]), 1)
+        self.assertEqual(len(mail.outbox), 6)
+        self.assertEqual(sum(backends.delivered.values()), 6)
+        self.assertEqual(CountingEmailBackend.opened, 1)
+        # the backend is not in a run anymore, so messages go out at once
+        backend.send_messages([mail.EmailMessage("subject", "body", to=["one@test.com"])])
+        self.assertEqual(len(mail.outbox), 7)
+
+    def test_reconnect(self):
+        CountingEmailBackend.failures = 1
+        send_now(self.users, "label")
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(CountingEmailBackend.opened, 2)
+
+    @override_settings(NOTIFICATIONS_EMAIL_BATCH_SIZE=5)
+    def test_reconnect_resumes(self):
+        CountingEmailBackend.failures = 1
+        CountingEmailBackend.drop_after = 2
+        send_now(self.users, "label")
+        # the messages sent before the connection dropped don't go out again
+        self.assertEqual([message.to[0] for message in mail.outbox], [user.email for user in self.users])
+        self.assertEqual(CountingEmailBackend.opened, 2)
+
+    @override_settings(NOTIFICATIONS_EMAIL_BATCH_SIZE=5)
+    def test_recipient_refused(self):
+        CountingEmailBackend.refused = set([self.users[1].email])
+        send_now(self.users, "label")
+        self.assertEqual(
+            [message.to[0] for message in mail.outbox],
+            [user.email for user in self.users if user != self.users[1]]
+        )
+        self.assertEqual(CountingEmailBackend.opened, 1)
+        self.assertEqual(get_sink().get_counter("backend.delivered", backend="email"), 4)
+        self.assertEqual(get_sink().get_counter("backend.failed", backend="email"), 1)
+
+    @override_settings(NOTIFICATIONS_EMAIL_RECONNECT_ATTEMPTS=0)
+    def test_reconnect_gives_up(self):
+        CountingEmailBackend.failures = 1
+        self.assertRaises(smtplib.SMTPServerDisconnected, send_now, self.users, "label")
+        self.assertEqual(len(mail.outbox), 0)
+
+    @override_settings(NOTIFICATIONS_DELIVERY_CHUNK_SIZE=2)
+    def test_deliver_bulk(self):
+        calls = []
+        original = EmailBackend.deliver_bulk
+
+        def deliver_bulk(backend, notice_type, shared_context, recipients, attachments, sender):
+            calls.append([email for email, _ in recipients])
+            return original(backend, notice_type, shared_context, recipients, attachments, sender)
+
+        EmailBackend.deliver_bulk = deliver_bulk
+        try:
+            send_now(self.users + ["one@test.com"], "label")
+        finally:
+            EmailBackend.deliver_bulk = original
+        self.assertEqual(calls, [
+            ["user0@test.com", "user1@test.com"],
+            ["user2@test.com", "user3@test.com"],
+            ["user4@test.com"],
+            ["one@test.com"],
+        ])
+        self.assertEqual(len(mail.outbox), 6)
+
+    def test_deliver_bulk_default(self):
+        delivered = []
+
+        class SingleBackend(BaseBackend):
+            def deliver(self, notice_type, extra_context, attachments, recipient_email, sender,
+                        shared_context=None):
+                delivered.append((recipient_email, extra_context["user"]))
+
+        notice_type = NoticeType.objects.get(label="label")
+        SingleBackend(1).deliver_bulk(notice_type, None, [(user.email, {"user": user}) for user in self.users[:2]],
+                                      [], "sender@test.com")
+        self.assertEqual(delivered, [(user.email, user) for user in self.users[:2]])
+
+    @unittest.skipUnless(is_installed("concurrent.futures"), "needs the futures package on Python 2")
+    @override_settings(NOTIFICATIONS_DELIVERY_WORKERS=2, NOTIFICATIONS_DELIVERY_CHUNK_SIZE=2)
+    def test_concurrent(self):
+        sent_users = deliver_notice(self.users + ["one@test.com"], "label")
+        self.assertEqual(sent_users, self.users)
+        self.assertEqual(
+            sorted(message.to[0] for message in mail.outbox),
+            sorted([user.email for user in self.users] + ["one@test.com"])
+        )
+        # the users' messages go out in three chunks, the plain address through the default backend
+        self.assertEqual(get_sink().get_timing("backend.latency", backend="email")["count"], 3)
+        self.assertEqual(get_sink().get_counter("backend.delivered", backend="email"), 5)
+        self.assertEqual(NoticeHistory.objects.get().recipient.count(), 5)
+
+    @unittest.skipUnless(is_installed("concurrent.futures"), "needs the futures package on Python 2")
+    @override_settings(NOTIFICATIONS_DELIVERY_WORKERS=1, NOTIFICATIONS_DELIVERY_CHUNK_SIZE=2)
+    def test_concurrent_errors(self):
+        CountingEmailBackend.failures = 1
+        self.assertRaises(smtplib.SMTPServerDisconnected, send_now, self.users, "label")
+        self.assertEqual(len(mail.outbox), 3)
+        # the history only holds the users the notice reached
+        self.assertEqual(
+            set(NoticeHistory.objects.get().recipient.values_list("email", flat=True)),
+            set(message.to[0] for message in mail.outbox)
+        )
+
+
+class LegacyBackend(BaseBackend):
+    """
+    A backend written against the original ``deliver`` signature.
+    """
+    spam_sensitivity = 2
+
+    def __init__(self, medium_id, spam_sensitivity=None):
+        super(LegacyBackend, self).__init__(medium_id, spam_sensitivity)
+        self.delivered = []
+        self.blocked = set()
+
+    def can_send(self, user, notice_type, scoping):
+        return user.pk not in self.blocked and super(LegacyBackend, self).can_send(user, notice_type, scoping)
+
+    def deliver(self, notice_type, extra_context, attachments, recipient_email, sender):
+        self.delivered.append((recipient_email, extra_context))
+
+
+@override_settings(SITE_ID=1)
+class TestCustomBackend(TestCase):
+    def setUp(self):
+        self.users = [
+            get_user_model().objects.create_user("user{0}".format(i), "user{0}@test.com".format(i), "123456")
+            for i in range(2)
+        ]
+        NoticeType.create("label", "display", "description")
+        self.backend = LegacyBackend(1)
+        settings.NOTIFICATIONS_BACKENDS[(1, "legacy")] = self.backend
+
+    def tearDown(self):
+        del settings.NOTIFICATIONS_BACKENDS[(1, "legacy")]
+
+    def test_extra_context(self):
+        extra_context = {"from_user": "alice"}
+        send_now(self.users, "label", extra_context)
+        self.assertEqual(self.backend.delivered, [
+            (user.email, {"from_user": "alice", "user": user}) for user in self.users
+        ])
+        self.assertEqual(extra_context, {"from_user": "alice"})
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_can_send(self):
+        self.backend.blocked.add(self.users[0].pk)
+        notice_type = NoticeType.objects.get(label="label")
+        self.assertEqual(self.backend.filter_can_send(self.users, notice_type, None), self.users[1:])
+        send_now(self.users, "label")
+        self.assertEqual([email for email, _ in self.backend.delivered], [self.users[1].email])
+
+
+@override_settings(SITE_ID=1)
+class TestRendering(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user("test_user", "test@user.com", "123456")
+        NoticeType.create("label", "display", "description")
+        self.notice_type = NoticeType.objects.get(label="label")
+        self.backend = settings.NOTIFICATIONS_DEFAULT_BACKEND
+        mail.outbox = []
+
+    def test_template_cached(self):
+        template = self.backend.get_template("email_body.html", "label")
+        self.assertIs(self.backend.get_template("email_body.html", "label"), template)
+
+    def test_default_context_cached(self):
+        self.backend.default_context()
+        with self.assertNumQueries(0):
+            context = self.backend.default_context()
+        self.assertEqual(context["base_url"], "http://example.com")
+
+    def test_shared_context_untouched(self):
+        context = self.backend.get_shared_context(self.notice_type, {"foo": "bar"}, "sender@test.com")
+        depth = len(context.dicts)
+        self.backend.build_message(self.notice_type, {"user": self.user}, [], self.user.email,
+                                   shared_context=context)
+        self.assertEqual(len(context.dicts), depth)
+        self.assertNotIn("user", context)
+        self.assertNotIn("recipient_email", context)
+        self.assertTrue(context.autoescape)
+
+    def test_extra_context_not_modified(self):
+        extra_context = {"foo": "bar"}
+        send_now([self.user], "label", extra_context)
+        self.assertEqual(extra_context, {"foo": "bar"})
+        self.assertEqual(mail.outbox[0].subject, "[example.com] display")
+
+    def test_attachments_shared(self):
+        attachment = os.path.join(os.path.dirname(__file__), "settings.py")
+        send_now([self.user, "one@test.com"], "label", attachments=[attachment])
+        self.assertEqual(len(mail.outbox), 2)
+        first, second = mail.outbox[0].attachments[0], mail.outbox[1].attachments[0]
+        self.assertEqual(first[0], "settings.py")
+        self.assertEqual(first[2], "text/x-python")
+        self.assertIs(first[1], second[1])
+
+
+@override_settings(SITE_ID=1)
+class TestDigestRendering(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user("test_user", "test@user.com", "123456")
+        NoticeType.create("label", "display", "description")
+        NoticeType.create("label2", "display2", "description2")
+        self.backend = settings.NOTIFICATIONS_DEFAULT_BACKEND
+        get_cache("digest_entries", settings.NOTIFICATIONS_DIGEST_CACHE,
+                  settings.NOTIFICATIONS_DIGEST_CACHE_SIZE).clear()
+
+    def test_fragment_template(self):
+        send_now([self.user], "label", {"message": "hello"})
+        history = list(NoticeHistory.objects.select_related("notice_type"))
+        renderings = self.backend.render_history(history)
+        self.assertEqual(renderings, [(history[0], "<p>display: hello</p>\n")])
+
+    def test_email_body_fallback(self):
+        send_now([self.user], "label2")
+        history = list(NoticeHistory.objects.select_related("notice_type"))
+        _, html = self.backend.render_history(history)[0]
+        self.assertIn("<h1>Hello!</h1>", html)
+        self.assertNotIn("<body>", html)
+
+    def test_fragments_cached(self):
+        send_now([self.user], "label", {"message": "hello"})
+        send_now([self.user], "label2")
+        history = list(NoticeHistory.objects.select_related("notice_type"))
+        renderings = self.backend.render_history(history)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.backend.render_history(history), renderings)
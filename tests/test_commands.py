@@ -1,13 +1,23 @@
 import time
+import base64
+import warnings
+import threading
 
+from django.db import OperationalError
 from django.utils import timezone
 from django.core import management, mail
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.test.utils import override_settings
 from django.contrib.auth import get_user_model
 
+from six.moves import cPickle
+
 from notifications.models import NoticeType, queue, NoticeQueueBatch, send_now, NoticeHistory, DigestSubscription
-from notifications.engine import send_digest
+from notifications.signals import notice_sent
+from notifications.engine import (
+    send_digest, send_all, send_subscriptions, group_notices,
+    collect_subscription_notifications, run_emitter,
+)
 
 
 class TestManagementCmd(TestCase):
@@ -71,3 +81,277 @@ class TestManagementCmd(TestCase):
         time.sleep(8)
         management.call_command("emit_subscriptions")
         self.assertEqual(len(mail.outbox), 3)
+
+    @override_settings(SITE_ID=1)
+    def test_claim(self):
+        queue([self.user], "label")
+        batch = NoticeQueueBatch.objects.get()
+        self.assertTrue(batch.claim("worker-a"))
+        self.assertFalse(NoticeQueueBatch.objects.get().claim("worker-b"))
+        self.assertTrue(batch.renew_lease())
+        # an expired lease can be taken over
+        NoticeQueueBatch.objects.update(lease_until=timezone.now() - timezone.timedelta(seconds=1))
+        other = NoticeQueueBatch.objects.get()
+        self.assertTrue(other.claim("worker-b"))
+        self.assertFalse(batch.renew_lease())
+        other.release()
+        self.assertTrue(batch.claim("worker-a"))
+
+    @override_settings(SITE_ID=1)
+    def test_emit_lock_path_ignored(self):
+        queue([self.user], "label")
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            self.assertEqual(send_all("send_notices"), 1)
+            queue([self.user2], "label")
+            management.call_command("emit_notices", "send_notices")
+        self.assertEqual([warning.category for warning in caught], [DeprecationWarning] * 2)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertRaises(TypeError, send_all, lock="send_notices")
+
+    @override_settings(SITE_ID=1)
+    def test_claim_stale(self):
+        queue([self.user, self.user2], "label")
+        batch, stale = NoticeQueueBatch.objects.get(), NoticeQueueBatch.objects.get()
+        self.assertTrue(batch.claim("worker-a"))
+        self.assertTrue(batch.checkpoint(1))
+        batch.fail("error")
+        # the batch was put off for a retry
+        self.assertFalse(stale.claim("worker-b"))
+        NoticeQueueBatch.objects.update(send_at=None)
+        self.assertTrue(stale.claim("worker-b"))
+        self.assertEqual((stale.position, stale.attempts), (1, 1))
+
+    @override_settings(SITE_ID=1, NOTIFICATIONS_QUEUE_MAX_ATTEMPTS=1)
+    def test_claim_failed(self):
+        queue([self.user], "label")
+        batch, stale = NoticeQueueBatch.objects.get(), NoticeQueueBatch.objects.get()
+        self.assertTrue(batch.claim("worker-a"))
+        self.assertTrue(batch.fail("error"))
+        # a worker holding an older snapshot can't emit the failed batch
+        self.assertFalse(stale.claim("worker-b"))
+        NoticeQueueBatch.objects.requeue()
+        self.assertTrue(stale.claim("worker-b"))
+        self.assertIsNone(stale.failed_at)
+
+    @override_settings(SITE_ID=1)
+    def test_emit_skips_claimed_batches(self):
+        queue([self.user], "label")
+        queue([self.user2], "label")
+        claimed = NoticeQueueBatch.objects.order_by("pk")[0]
+        claimed.claim("other-worker")
+        send_all()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn(self.user2.email, mail.outbox[0].to)
+        self.assertEqual(list(NoticeQueueBatch.objects.all()), [claimed])
+        # once the other worker's lease has expired the batch is recovered
+        NoticeQueueBatch.objects.update(lease_until=timezone.now() - timezone.timedelta(seconds=1))
+        send_all()
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(NoticeQueueBatch.objects.count(), 0)
+
+    @override_settings(SITE_ID=1, NOTIFICATIONS_QUEUE_CHUNK_SIZE=1)
+    def test_emit_resumes_from_checkpoint(self):
+        user3 = get_user_model().objects.create_user("test_user3", "test3@user.com", "123456")
+        queue([self.user, self.user2, user3], "label")
+        NoticeQueueBatch.objects.update(position=1)
+        send_all()
+        self.assertEqual([message.to for message in mail.outbox], [[self.user2.email], [user3.email]])
+        self.assertEqual(NoticeQueueBatch.objects.count(), 0)
+
+    @override_settings(SITE_ID=1, NOTIFICATIONS_QUEUE_MAX_ATTEMPTS=2, NOTIFICATIONS_QUEUE_RETRY_DELAY=0)
+    def test_emit_failed_batch(self):
+        queue([self.user], "missing")
+        queue([self.user2], "label")
+        send_all()
+        self.assertEqual(len(mail.outbox), 1)
+        batch = NoticeQueueBatch.objects.get()
+        self.assertEqual(batch.attempts, 1)
+        self.assertIn("DoesNotExist", batch.last_error)
+        self.assertIsNone(batch.claimed_by)
+        self.assertIsNone(batch.failed_at)
+        send_all()
+        batch = NoticeQueueBatch.objects.get()
+        self.assertEqual(batch.attempts, 2)
+        self.assertIsNotNone(batch.failed_at)
+        self.assertEqual(NoticeQueueBatch.objects.due().count(), 0)
+        self.assertEqual(NoticeQueueBatch.objects.failed().count(), 1)
+        NoticeQueueBatch.objects.requeue()
+        self.assertEqual(NoticeQueueBatch.objects.due().count(), 1)
+
+    @override_settings(SITE_ID=1, NOTIFICATIONS_QUEUE_RETRY_DELAY=0)
+    def test_emit_failed_group_not_repeated(self):
+        notices = [(self.user.email, "label", {}, None, []), (self.user2.email, "missing", {}, None, [])]
+        NoticeQueueBatch.objects.create(pickled_data=base64.b64encode(cPickle.dumps(notices)))
+        for i in range(6):
+            send_all()
+        # the group that was sent is checkpointed and never sent or recorded again
+        self.assertEqual([message.to for message in mail.outbox], [[self.user.email]])
+        self.assertEqual(NoticeHistory.objects.count(), 1)
+        batch = NoticeQueueBatch.objects.get()
+        self.assertEqual(batch.position, 1)
+        self.assertIsNotNone(batch.failed_at)
+
+    @override_settings(SITE_ID=1)
+    def test_emit_retry_delay(self):
+        queue([self.user], "missing")
+        start = timezone.now()
+        send_all()
+        batch = NoticeQueueBatch.objects.get()
+        self.assertGreaterEqual(batch.send_at, start + timezone.timedelta(seconds=60))
+        self.assertEqual(NoticeQueueBatch.objects.due().count(), 0)
+        # the delay doubles with every attempt
+        NoticeQueueBatch.objects.update(send_at=start)
+        send_all()
+        self.assertGreaterEqual(NoticeQueueBatch.objects.get().send_at, start + timezone.timedelta(seconds=120))
+
+    @override_settings(SITE_ID=1)
+    def test_emit_groups_recipients(self):
+        user3 = get_user_model().objects.create_user("test_user3", "test3@user.com", "123456")
+        queue([self.user, self.user2, user3], "label")
+        send_all()
+        self.assertEqual(len(mail.outbox), 3)
+        history = NoticeHistory.objects.get()
+        self.assertEqual(history.recipient.count(), 3)
+
+    @override_settings(SITE_ID=1)
+    def test_emit_priority(self):
+        user3 = get_user_model().objects.create_user("test_user3", "test3@user.com", "123456")
+        queue([self.user], "label", priority=10)
+        queue([self.user2], "label")
+        queue([user3], "label", priority=-10)
+        send_all(max_priority=0)
+        self.assertEqual([message.to for message in mail.outbox], [[user3.email], [self.user2.email]])
+        self.assertEqual(list(NoticeQueueBatch.objects.values_list("priority", flat=True)), [10])
+
+    @override_settings(SITE_ID=1, NOTIFICATIONS_QUEUE_BATCH_SIZE=1)
+    def test_emit_preempted(self):
+        user3 = get_user_model().objects.create_user("test_user3", "test3@user.com", "123456")
+        queue([self.user, self.user2], "label", priority=10)
+
+        def queue_urgent(sender, **kwargs):
+            notice_sent.disconnect(queue_urgent)
+            queue([user3], "label")
+        notice_sent.connect(queue_urgent)
+        try:
+            send_all()
+        finally:
+            notice_sent.disconnect(queue_urgent)
+        self.assertEqual(
+            [message.to for message in mail.outbox],
+            [[self.user.email], [user3.email], [self.user2.email]]
+        )
+
+    def test_group_notices(self):
+        notices = [
+            (1, "label", {"a": 1}, None, []),
+            (2, "label", {"a": 1}, None, []),
+            (3, "label", {"a": 2}, None, []),
+            (4, "label2", {"a": 2}, None, []),
+            (5, "label2", {"a": 2}, None, []),
+        ]
+        self.assertEqual(list(group_notices(notices)), [
+            ([1, 2], "label", {"a": 1}, None, []),
+            ([3], "label", {"a": 2}, None, []),
+            ([4, 5], "label2", {"a": 2}, None, []),
+        ])
+
+    @override_settings(SITE_ID=1)
+    def test_collect_subscription_notifications(self):
+        send_now([self.user], "label")
+        send_now([self.user2], "label")
+        send_now([self.user, self.user2], "label2")
+        send_now([self.user], "different")
+        sub = DigestSubscription.objects.create(user=self.user, notice_type="label", frequency=60)
+        sub2 = DigestSubscription.objects.create(user=self.user2, notice_type="label2", frequency=60)
+        sub3 = DigestSubscription.objects.create(user=self.user2, notice_type="different", frequency=60)
+        with self.assertNumQueries(1):
+            collected = collect_subscription_notifications([sub, sub2, sub3])
+        self.assertEqual([history.notice_type.label for history in collected[sub.pk]], ["label"])
+        self.assertEqual(collected[sub.pk][0].recipient.get(), self.user)
+        self.assertEqual([history.notice_type.label for history in collected[sub2.pk]], ["label2"])
+        self.assertEqual(collected[sub3.pk], [])
+        # outside of the window
+        later = timezone.now() + timezone.timedelta(minutes=61)
+        self.assertEqual(collect_subscription_notifications([sub], later), {sub.pk: []})
+
+    @override_settings(SITE_ID=1)
+    def test_subscriptions_merged_per_user(self):
+        send_now([self.user], "label")
+        send_now([self.user], "label2")
+        DigestSubscription.objects.create(user=self.user, notice_type="label", frequency=60)
+        DigestSubscription.objects.create(user=self.user, notice_type="label2", frequency=60)
+        DigestSubscription.objects.create(user=self.user, notice_type="different", frequency=30)
+        mail.outbox = []
+        send_subscriptions()
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(mail.outbox[0].bcc, [self.user.email])
+        self.assertEqual(mail.outbox[0].body.count("Sent at"), 2)
+        self.assertEqual(mail.outbox[1].body.count("Sent at"), 0)
+        self.assertFalse(DigestSubscription.objects.filter(emit_at__lte=timezone.now()).exists())
+        send_subscriptions()
+        self.assertEqual(len(mail.outbox), 2)
+
+
+@override_settings(SITE_ID=1, NOTIFICATIONS_EMITTER_MIN_INTERVAL=0.01, NOTIFICATIONS_EMITTER_MAX_INTERVAL=0.05)
+class TestEmitter(TransactionTestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user("test_user", "test@user.com", "123456")
+        NoticeType.create("label", "display", "description")
+        mail.outbox = []
+
+    def test_next_due(self):
+        now = timezone.now()
+        self.assertIsNone(NoticeQueueBatch.objects.next_due(now))
+        queue([self.user], "label", send_at=now + timezone.timedelta(minutes=10))
+        queue([self.user], "label", send_at=now + timezone.timedelta(minutes=7))
+        self.assertEqual(NoticeQueueBatch.objects.next_due(now), now + timezone.timedelta(minutes=7))
+        queue([self.user], "label")
+        batch = NoticeQueueBatch.objects.get(send_at__isnull=True)
+        # the lease on the due batch runs out before the others are due
+        batch.claim("other")
+        self.assertEqual(NoticeQueueBatch.objects.next_due(now), NoticeQueueBatch.objects.get(pk=batch.pk).lease_until)
+
+    def test_run_emitter_survives_errors(self):
+        from notifications import engine
+
+        close_old_connections = engine.close_old_connections
+        failures = []
+
+        def fail_once():
+            if not failures:
+                failures.append(True)
+                raise OperationalError("the database is restarting")
+            close_old_connections()
+
+        queue([self.user], "label")
+        stop = threading.Event()
+        engine.close_old_connections = fail_once
+        thread = threading.Thread(target=run_emitter, args=(stop,))
+        thread.start()
+        try:
+            deadline = time.time() + 5
+            while not mail.outbox and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            stop.set()
+            thread.join()
+            engine.close_old_connections = close_old_connections
+        self.assertEqual(failures, [True])
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_run_emitter(self):
+        queue([self.user], "label")
+        queue([self.user], "label", send_at=timezone.now() + timezone.timedelta(seconds=0.3))
+        stop = threading.Event()
+        thread = threading.Thread(target=run_emitter, args=(stop,))
+        thread.start()
+        try:
+            deadline = time.time() + 5
+            while len(mail.outbox) < 2 and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            stop.set()
+            thread.join()
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(NoticeQueueBatch.objects.count(), 0)
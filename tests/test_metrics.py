@@ -0,0 +1,72 @@
+import time
+
+from django.core import mail
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.contrib.auth import get_user_model
+
+from notifications.metrics import collect_stages, stage, get_sink
+from notifications.models import NoticeType, send_now, queue
+from notifications.engine import send_all
+from notifications.signals import notice_sent, emitted_notices
+
+
+class TestStages(TestCase):
+    def test_nested_stages(self):
+        with collect_stages() as stages:
+            with stage("transport"):
+                with stage("render"):
+                    time.sleep(0.02)
+        self.assertGreaterEqual(stages["render"], 0.02)
+        self.assertLess(stages["transport"], 0.02)
+
+    def test_outside_collection(self):
+        with stage("render"):
+            pass
+        with collect_stages() as stages:
+            pass
+        self.assertEqual(stages, {})
+
+
+@override_settings(SITE_ID=1)
+class TestDeliveryMetrics(TestCase):
+    def setUp(self):
+        self.users = [
+            get_user_model().objects.create_user("user{0}".format(i), "user{0}@test.com".format(i), "123456")
+            for i in range(3)
+        ]
+        NoticeType.create("label", "display", "description")
+        self.sink = get_sink()
+        self.sink.reset()
+        self.received = []
+        mail.outbox = []
+
+    def receive(self, sender, **kwargs):
+        self.received.append(kwargs)
+
+    def test_notice_sent(self):
+        notice_sent.connect(self.receive)
+        try:
+            send_now(self.users, "label")
+        finally:
+            notice_sent.disconnect(self.receive)
+        self.assertEqual(len(self.received), 1)
+        self.assertEqual(self.received[0]["sent_users"], self.users)
+        self.assertEqual(
+            set(self.received[0]["stages"]),
+            set(["resolve", "preferences", "render", "transport", "history"])
+        )
+        self.assertEqual(self.sink.get_counter("backend.delivered", backend="email"), 3)
+        self.assertEqual(self.sink.get_timing("stage.render")["count"], 4)
+
+    def test_emitted_notices(self):
+        queue(self.users, "label")
+        emitted_notices.connect(self.receive)
+        try:
+            send_all()
+        finally:
+            emitted_notices.disconnect(self.receive)
+        self.assertEqual(self.received[0]["sent"], 3)
+        self.assertEqual(self.received[0]["delivered"], 3)
+        self.assertIn("transport", self.received[0]["stages"])
+        self.assertEqual(self.sink.get_timing("backend.latency", backend="email")["count"], 1)
@@ -2,15 +2,23 @@ import base64
 import time
 
 from django.core import mail
+from django.core.cache import caches
 from django.test import TestCase
 from django.test.utils import override_settings
+from django.db.models import F
 from django.utils import timezone
 from django.contrib.auth import get_user_model
 from django.contrib.sites.models import Site
 
 from six.moves import cPickle
-from notifications.models import NoticeType, NoticeQueueBatch, NoticeHistory, DigestSubscription
-from notifications.models import send_now, send, queue
+from notifications.models import NoticeType, NoticeQueueBatch, NoticeHistory, NoticeThrough, DigestSubscription
+from notifications.models import send_now, send, queue, NOTICE_TYPE_VERSION_KEY
+from notifications.engine import send_all
+from notifications.history import buffered_history
+from notifications.middleware import HistoryBufferMiddleware
+from notifications import models
+from notifications.models import get_notification_language, get_notification_languages, LanguageStoreNotAvailable
+from notifications.payload import encode_payload, decode_payload, PAYLOAD_JSON, PAYLOAD_PICKLE
 
 
 class BaseTest(TestCase):
@@ -39,6 +47,152 @@ class TestNoticeType(TestCase):
         self.assertEqual(n.description, "you got an invitation")
         self.assertEqual(n.default, 1)
 
+    def test_assets(self):
+        NoticeType.create("label", "display", "description", assets=["logo.png"])
+        notice_type = NoticeType.objects.get(label="label")
+        self.assertEqual(notice_type.get_assets(), ["logo.png"])
+        notice_type.set_assets(["logo.png", "banner.png"])
+        self.assertEqual(notice_type.get_assets(), ["logo.png", "banner.png"])
+
+    def test_get_for_label(self):
+        NoticeType.create("label", "display", "description", assets=["logo.png"])
+        notice_type = NoticeType.objects.get_for_label("label")
+        with self.assertNumQueries(0):
+            self.assertIs(NoticeType.objects.get_for_label("label"), notice_type)
+            self.assertIs(NoticeType.objects.get_for_id(notice_type.pk), notice_type)
+            self.assertEqual(notice_type.get_assets(), ["logo.png"])
+        self.assertRaises(NoticeType.DoesNotExist, NoticeType.objects.get_for_label, "missing")
+        # saving a notice type clears the cache
+        NoticeType.create("label", "changed", "description")
+        self.assertEqual(NoticeType.objects.get_for_label("label").display, "changed")
+
+    @override_settings(NOTIFICATIONS_TYPE_CACHE="default")
+    def test_shared_version(self):
+        NoticeType.create("label", "display", "description")
+        NoticeType.objects.get_for_label("label")
+        # another process changes the notice type
+        NoticeType.objects.filter(label="label").update(display="changed")
+        self.assertEqual(NoticeType.objects.get_for_label("label").display, "display")
+        caches["default"].set(NOTICE_TYPE_VERSION_KEY, "other")
+        self.assertEqual(NoticeType.objects.get_for_label("label").display, "changed")
+
+
+class SubscriptionLanguage(object):
+    """
+    Stands in for a language model, reading each user's language from the
+    notice_type of a DigestSubscription.
+    """
+    class objects(object):
+        @staticmethod
+        def filter(**kwargs):
+            return DigestSubscription.objects.filter(**kwargs).annotate(language=F("notice_type"))
+
+
+@override_settings(SITE_ID=1)
+class TestNotificationLanguage(BaseTest):
+    def test_language_store_not_available(self):
+        with self.assertNumQueries(0):
+            self.assertRaises(LanguageStoreNotAvailable, get_notification_languages, [self.user, self.user2])
+
+    @override_settings(NOTIFICATIONS_LANGUAGE_MODEL="tests.SubscriptionLanguage",
+                       NOTIFICATIONS_GET_LANGUAGE_MODEL=lambda: SubscriptionLanguage)
+    def test_languages(self):
+        user3 = get_user_model().objects.create_user("test_user3", "test3@user.com", "123456")
+        user4 = get_user_model().objects.create_user("test_user4", "test4@user.com", "123456")
+        DigestSubscription.objects.create(user=self.user, notice_type="fr", frequency=60)
+        DigestSubscription.objects.create(user=self.user2, notice_type="de", frequency=60)
+        DigestSubscription.objects.create(user=user4, notice_type="fr", frequency=60)
+        users = [self.user, self.user2, user3, user4]
+        with self.assertNumQueries(1):
+            languages = get_notification_languages(users)
+        self.assertEqual(languages, {self.user.pk: "fr", self.user2.pk: "de", user4.pk: "fr"})
+        self.assertEqual(get_notification_language(self.user2), "de")
+        self.assertRaises(LanguageStoreNotAvailable, get_notification_language, user3)
+
+        activated = []
+        activate = models.activate
+
+        def record_activate(language):
+            activated.append(language)
+            activate(language)
+
+        models.activate = record_activate
+        try:
+            send_now(users, "label")
+        finally:
+            models.activate = activate
+        # each language is activated once, for all of its users
+        self.assertEqual([language for language in activated if language in ("fr", "de")], ["fr", "de"])
+        self.assertEqual(len(mail.outbox), 4)
+
+
+class TestQueuePayload(BaseTest):
+    def test_json_payload(self):
+        payload = encode_payload(["test@user.com", "test2@user.com"], "label", {"count": 2}, None, [])
+        self.assertEqual(bytearray(payload[:1])[0], PAYLOAD_JSON)
+        self.assertEqual(decode_payload(payload), {
+            "recipients": ["test@user.com", "test2@user.com"],
+            "label": "label",
+            "extra_context": {"count": 2},
+            "sender": None,
+            "attachments": [],
+        })
+
+    def test_pickle_payload(self):
+        extra_context = {"when": timezone.now(), "pair": (1, 2)}
+        payload = encode_payload(["test@user.com"], "label", extra_context, None, [])
+        self.assertEqual(bytearray(payload[:1])[0], PAYLOAD_PICKLE)
+        self.assertEqual(decode_payload(payload)["extra_context"], extra_context)
+
+    def test_shared_fields_stored_once(self):
+        extra_context = {"text": "x" * 1000}
+        queue([self.user, self.user2], "label", extra_context)
+        batch = NoticeQueueBatch.objects.get()
+        self.assertLess(len(batch.payload), 1000)
+        self.assertEqual(batch.get_notices(), [
+            (self.user.pk, "label", extra_context, None, []),
+            (self.user2.pk, "label", extra_context, None, []),
+        ])
+
+    def test_legacy_batch(self):
+        notices = [(self.user.email, "label", {}, None, [])]
+        batch = NoticeQueueBatch.objects.create(pickled_data=base64.b64encode(cPickle.dumps(notices)))
+        batch = NoticeQueueBatch.objects.get(pk=batch.pk)
+        self.assertEqual(batch.get_notices(), notices)
+
+
+@override_settings(SITE_ID=1)
+class TestHistory(BaseTest):
+    def test_buffered(self):
+        with buffered_history():
+            send_now([self.user], "label")
+            send_now([self.user, self.user2], "label")
+            self.assertEqual(NoticeHistory.objects.count(), 0)
+        self.assertEqual(NoticeHistory.objects.count(), 2)
+        self.assertEqual(NoticeThrough.objects.count(), 3)
+
+    @override_settings(NOTIFICATIONS_HISTORY_BUFFER_SIZE=3)
+    def test_buffer_size(self):
+        with buffered_history():
+            send_now([self.user], "label")
+            self.assertEqual(NoticeHistory.objects.count(), 0)
+            send_now([self.user], "label")
+            self.assertEqual(NoticeHistory.objects.count(), 2)
+
+    @override_settings(NOTIFICATIONS_HISTORY_DISABLED_TYPES=["label"])
+    def test_disabled(self):
+        send_now([self.user], "label")
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(NoticeHistory.objects.count(), 0)
+
+    def test_middleware(self):
+        middleware = HistoryBufferMiddleware()
+        middleware.process_request(None)
+        send_now([self.user], "label")
+        self.assertEqual(NoticeHistory.objects.count(), 0)
+        middleware.process_response(None, None)
+        self.assertEqual(NoticeHistory.objects.count(), 1)
+
 
 class TestDigestSubscription(BaseTest):
     def test_create(self):
@@ -92,7 +246,7 @@ class TestProcedures(BaseTest):
         send(users, "label", queue=True)
         self.assertEqual(NoticeQueueBatch.objects.count(), 1)
         batch = NoticeQueueBatch.objects.all()[0]
-        notices = cPickle.loads(base64.b64decode(batch.pickled_data))
+        notices = batch.get_notices()
         self.assertEqual(len(notices), 2)
 
     @override_settings(SITE_ID=1)
@@ -103,6 +257,19 @@ class TestProcedures(BaseTest):
         self.assertEqual(len(mail.outbox), 2)
         self.assertEqual(NoticeQueueBatch.objects.count(), 0)
 
+    def test_queue_due(self):
+        now = timezone.now()
+        queue([self.user], "label", send_at=now + timezone.timedelta(minutes=10))
+        queue([self.user], "label", send_at=now - timezone.timedelta(minutes=5))
+        queue([self.user], "label")
+        queue([self.user], "label", send_at=now - timezone.timedelta(minutes=10))
+        due = list(NoticeQueueBatch.objects.due(now))
+        # batches without a send_at come first whatever the database
+        self.assertEqual(
+            [batch.send_at for batch in due],
+            [None, now - timezone.timedelta(minutes=10), now - timezone.timedelta(minutes=5)]
+        )
+
     @override_settings(SITE_ID=1)
     def test_queue_queryset(self):
         users = get_user_model().objects.all()
@@ -110,6 +277,16 @@ class TestProcedures(BaseTest):
         self.assertEqual(len(mail.outbox), 0)
         self.assertEqual(NoticeQueueBatch.objects.count(), 1)
 
+    @override_settings(SITE_ID=1, NOTIFICATIONS_QUEUE_BATCH_SIZE=1)
+    def test_queue_queryset_batches(self):
+        users = get_user_model().objects.order_by("pk")
+        queue(users, "label")
+        batches = NoticeQueueBatch.objects.order_by("pk")
+        self.assertEqual([batch.get_notices()[0][0] for batch in batches], [self.user.pk, self.user2.pk])
+        send_all()
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(NoticeQueueBatch.objects.count(), 0)
+
     @override_settings(SITE_ID=1)
     def test_non_user_send(self):
         emails = ["one@test.com", "two@test.com"]
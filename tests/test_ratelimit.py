@@ -0,0 +1,87 @@
+import time
+
+from django.core import mail
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.contrib.auth import get_user_model
+
+from notifications.conf import settings
+from notifications.metrics import get_sink
+from notifications.models import NoticeType, send_now
+from notifications.ratelimit import TokenBucket, CacheTokenBucket, get_bucket, batch_size
+from tests.test_backends import CountingEmailBackend
+
+
+class TestTokenBucket(TestCase):
+    def test_reserve(self):
+        bucket = TokenBucket(10, 2)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        # each token beyond the burst is a tenth of a second further away
+        self.assertAlmostEqual(bucket.reserve(), 0.1, places=2)
+        self.assertAlmostEqual(bucket.reserve(), 0.2, places=2)
+
+    def test_cache_reserve(self):
+        caches["default"].clear()
+        bucket = CacheTokenBucket(10, 2, key="test")
+        delays = [bucket.reserve() for _ in range(5)]
+        self.assertEqual(delays[:2], [0, 0])
+        # past the burst one token every tenth of a second, wherever the calls fall
+        self.assertTrue(0 < delays[2] <= 0.1)
+        self.assertAlmostEqual(delays[3] - delays[2], 0.1, places=2)
+        self.assertAlmostEqual(delays[4] - delays[3], 0.1, places=2)
+        self.assertAlmostEqual(bucket.reserve(3) - delays[4], 0.3, places=2)
+
+    def test_cache_shared(self):
+        caches["default"].clear()
+        first, second = CacheTokenBucket(10, 2, key="test"), CacheTokenBucket(10, 2, key="test")
+        self.assertEqual([first.reserve(), second.reserve()], [0, 0])
+        self.assertTrue(0 < second.reserve() <= 0.1)
+
+    @override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"}})
+    def test_cache_unusable(self):
+        self.assertRaises(ImproperlyConfigured, CacheTokenBucket, 10, 2, key="test")
+
+
+@override_settings(SITE_ID=1)
+class TestRateLimits(TestCase):
+    def setUp(self):
+        self.users = [
+            get_user_model().objects.create_user("user{0}".format(i), "user{0}@test.com".format(i), "123456")
+            for i in range(3)
+        ]
+        NoticeType.create("label", "display", "description")
+        get_sink().reset()
+
+    def test_unlimited(self):
+        backend = settings.NOTIFICATIONS_BACKENDS[(0, "email")]
+        self.assertIsNone(get_bucket(backend))
+        self.assertEqual(batch_size(backend, 50), 50)
+
+    @override_settings(NOTIFICATIONS_RATE_LIMITS={"email": (20, 1)})
+    def test_send_paced(self):
+        backend = settings.NOTIFICATIONS_BACKENDS[(0, "email")]
+        self.assertEqual(batch_size(backend, 50), 1)
+        start = time.time()
+        send_now(self.users, "label")
+        self.assertGreaterEqual(time.time() - start, 0.1)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(get_sink().get_timing("backend.throttled", backend="email")["count"], 2)
+
+    @override_settings(NOTIFICATIONS_RATE_LIMITS={"email": (1000, 10)},
+                       EMAIL_BACKEND="tests.test_backends.CountingEmailBackend")
+    def test_reconnect_reserves_once(self):
+        backend = settings.NOTIFICATIONS_BACKENDS[(0, "email")]
+        bucket = get_bucket(backend)
+        reserved = []
+        bucket.reserve = lambda tokens=1: reserved.append(tokens) or 0.0
+        CountingEmailBackend.failures = 1
+        try:
+            send_now(self.users, "label")
+        finally:
+            del bucket.reserve
+            CountingEmailBackend.failures = 0
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(reserved, [3])
@@ -0,0 +1,138 @@
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.contrib.auth import get_user_model
+
+from notifications.cache import LRUCache, FileCache
+from notifications.conf import settings
+from notifications.models import NoticeType, NoticeSetting
+from notifications.utils import (
+    chunked, get_users_by_email, resolve_recipients,
+    notice_settings_for_users, get_notice_setting_cache,
+)
+
+
+class TestChunked(TestCase):
+    def test_chunked(self):
+        self.assertEqual(list(chunked(range(5), 2)), [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(chunked([], 2)), [])
+
+
+class TestResolveRecipients(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user("test_user", "test@user.com", "123456")
+        self.user2 = get_user_model().objects.create_user("test_user2", "test2@user.com", "123456")
+        self.user3 = get_user_model().objects.create_user("test_user3", "test3@user.com", "123456")
+
+    def test_get_users_by_email(self):
+        emails = ["test@user.com", "test2@user.com", "test3@user.com", "none@user.com"]
+        with self.assertNumQueries(2):
+            users = get_users_by_email(emails, chunk_size=2)
+        self.assertEqual(users, {
+            "test@user.com": self.user,
+            "test2@user.com": self.user2,
+            "test3@user.com": self.user3,
+        })
+
+    def test_resolve_mixed(self):
+        value_list = [self.user, "test2@user.com", "one@test.com", "test3@user.com", "two@test.com"]
+        with self.assertNumQueries(1):
+            users, emails = resolve_recipients(value_list)
+        self.assertEqual(users, [self.user, self.user2, self.user3])
+        self.assertEqual(emails, ["one@test.com", "two@test.com"])
+
+    def test_resolve_duplicates(self):
+        value_list = [self.user, "test@user.com", "one@test.com", "one@test.com"]
+        users, emails = resolve_recipients(value_list)
+        self.assertEqual(users, [self.user])
+        self.assertEqual(emails, ["one@test.com"])
+
+
+class TestNoticeSettings(TestCase):
+    def setUp(self):
+        self.users = [
+            get_user_model().objects.create_user("user{0}".format(i), "user{0}@test.com".format(i), "123456")
+            for i in range(3)
+        ]
+        NoticeType.create("label", "display", "description")
+        self.notice_type = NoticeType.objects.get(label="label")
+        NoticeSetting.objects.create(user=self.users[1], notice_type=self.notice_type, medium=0, send=False)
+
+    def test_bulk_lookup(self):
+        with self.assertNumQueries(1):
+            allowed = notice_settings_for_users(self.users, self.notice_type, 0)
+        self.assertEqual(allowed, {self.users[0].pk: True, self.users[1].pk: False, self.users[2].pk: True})
+        # defaults are computed, not saved
+        self.assertEqual(NoticeSetting.objects.count(), 1)
+
+    def test_backend_filter(self):
+        backend = settings.NOTIFICATIONS_DEFAULT_BACKEND
+        self.assertEqual(backend.filter_can_send(self.users, self.notice_type, None),
+                         [self.users[0], self.users[2]])
+        self.assertFalse(backend.can_send(self.users[1], self.notice_type, None))
+
+    @override_settings(NOTIFICATIONS_SETTINGS_CACHE="local")
+    def test_cache(self):
+        get_notice_setting_cache().clear()
+        notice_settings_for_users(self.users, self.notice_type, 0)
+        with self.assertNumQueries(0):
+            allowed = notice_settings_for_users(self.users, self.notice_type, 0)
+        self.assertFalse(allowed[self.users[1].pk])
+
+        setting = NoticeSetting.objects.get(user=self.users[1])
+        setting.send = True
+        setting.save()
+        NoticeSetting.objects.create(user=self.users[2], notice_type=self.notice_type, medium=0, send=False)
+        allowed = notice_settings_for_users(self.users, self.notice_type, 0)
+        self.assertEqual(allowed, {self.users[0].pk: True, self.users[1].pk: True, self.users[2].pk: False})
+        get_notice_setting_cache().clear()
+
+
+class TestLRUCache(TestCase):
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("c", 3)
+        self.assertEqual(cache.get_many(["a", "b", "c"]), {"a": 1, "c": 3})
+
+
+class TestFileCache(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data, mtime):
+        path = os.path.join(self.dir, name)
+        with open(path, "wb") as fp:
+            fp.write(data)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_reads_once_until_modified(self):
+        cache = FileCache(10)
+        built = []
+        path = self.write("a", b"abc", 1000)
+        self.assertEqual(cache.get(path, lambda data: built.append(data) or data), b"abc")
+        self.assertEqual(cache.get(path, lambda data: built.append(data) or data), b"abc")
+        self.assertEqual(built, [b"abc"])
+        self.write("a", b"abcd", 2000)
+        self.assertEqual(cache.get(path, lambda data: data), b"abcd")
+        self.assertEqual(cache.size, 4)
+
+    def test_size_limit(self):
+        cache = FileCache(6)
+        a = self.write("a", b"aaa", 1000)
+        b = self.write("b", b"bbb", 1000)
+        c = self.write("c", b"ccc", 1000)
+        big = self.write("big", b"x" * 7, 1000)
+        for path in (a, b, c, big):
+            cache.get(path, len)
+        self.assertEqual(list(cache._data), [b, c])
+        self.assertEqual(cache.size, 6)